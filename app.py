@@ -1,13 +1,30 @@
+import atexit
+import collections
 import os
-import json
-import math
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from cachetools import TTLCache, cached
+import orjson
 from markdown_it import MarkdownIt
-import traceback
 import uuid
 from authlib.integrations.flask_client import OAuth
 from flask import Flask, render_template, request, redirect, url_for, session, jsonify, flash, send_from_directory, make_response
+from flask.json.provider import DefaultJSONProvider
+from flask.logging import default_handler
+from flask_compress import Compress
+from flask_session import Session
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+from jinja2 import FileSystemBytecodeCache
+import redis
 from google.cloud import discoveryengine_v1alpha as discoveryengine
-from google.api_core.exceptions import GoogleAPICallError
+from google.api_core.exceptions import DeadlineExceeded, GoogleAPICallError
+from google.api_core.retry import if_transient_error
 from google.cloud.retail_v2alpha import ConversationalSearchServiceClient
 from google.cloud.retail_v2alpha.types import ConversationalSearchRequest, ConversationalSearchResponse
 from google.cloud.retail_v2 import (
@@ -17,33 +34,134 @@ from google.cloud.retail_v2 import (
     SearchServiceClient,
     CompletionServiceClient,
 )
+from google.cloud.retail_v2.services.completion_service.transports import CompletionServiceGrpcTransport
+from google.cloud.retail_v2.services.prediction_service.transports import PredictionServiceGrpcTransport
+from google.cloud.retail_v2.services.product_service.transports import ProductServiceGrpcTransport
+from google.cloud.retail_v2.services.search_service.transports import SearchServiceGrpcTransport
+from google.cloud.retail_v2.services.user_event_service.transports import UserEventServiceGrpcTransport
 from google.cloud.retail_v2.types import (
     ListProductsRequest,
     CompleteQueryRequest,
     PredictRequest,
     PredictResponse,
     Product,
+    ProductDetail,
+    PriceInfo,
+    PurchaseTransaction,
     SearchResponse,
-    WriteUserEventRequest,
     SearchRequest,
     UserEvent,
     UserInfo,
     Interval,
+    ImportUserEventsRequest,
+    UserEventInputConfig,
+    UserEventInlineSource,
 )
-from google.protobuf import struct_pb2
+from google.protobuf import json_format, struct_pb2
 from werkzeug.middleware.proxy_fix import ProxyFix
 
-from google.cloud import dialogflowcx_v3
-from google.api_core.client_options import ClientOptions
-
 import config
 
+
+class OrjsonJSONProvider(DefaultJSONProvider):
+    """
+    A JSON provider that uses orjson instead of the standard library `json`
+    module. It is used by `jsonify`, `request.get_json()` and the Jinja
+    `|tojson` filter, so every JSON payload the app emits benefits from it.
+    """
+
+    def dumps(self, obj, **kwargs):
+        option = orjson.OPT_NON_STR_KEYS
+        if kwargs.get('sort_keys', self.sort_keys):
+            option |= orjson.OPT_SORT_KEYS
+        if kwargs.get('indent'):
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, default=self.default, option=option).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
 app = Flask(__name__, template_folder="templates", static_folder="static")
 
+# Swap in the orjson-backed provider before the Jinja environment is created,
+# as Flask binds the `|tojson` filter to the provider at that point.
+app.json = OrjsonJSONProvider(app)
+
+# Set the application log level from config. Payload dumps for the API calls
+# are only produced when this is set to DEBUG.
+app.logger.setLevel(config.LOG_LEVEL)
+
+# Log records are handed to a background thread through a queue, so the write
+# to stderr (and any wait on the stream's lock) happens off the request thread.
+# The record's message, and its traceback if any, are still formatted on the
+# calling thread by QueueHandler.prepare before it is queued. The listener is
+# stopped (after draining the queue) when the process exits.
+_log_queue = None
+_log_stream_handler = logging.StreamHandler(sys.stderr)
+_log_stream_handler.setFormatter(default_handler.formatter)
+_log_listener = None
+_log_listener_lock = threading.Lock()
+_log_listener_pid = None
+
+
+def _ensure_log_listener():
+    """
+    Starts the thread that writes out queued log records for the current
+    process. Like the event flusher, this is done lazily rather than at import
+    time so that each forked server worker gets its own thread, along with its
+    own queue (a queue inherited from the parent may have been locked by the
+    parent's listener at the moment of the fork).
+    """
+    global _log_queue, _log_listener, _log_listener_pid
+    if _log_listener_pid == os.getpid():
+        return
+    with _log_listener_lock:
+        if _log_listener_pid != os.getpid():
+            _log_queue = queue.SimpleQueue()
+            _log_listener = logging.handlers.QueueListener(_log_queue, _log_stream_handler)
+            _log_listener.start()
+            _log_listener_pid = os.getpid()
+
+
+class _LazyQueueHandler(logging.handlers.QueueHandler):
+    """
+    A QueueHandler that queues records for the current process's listener,
+    starting it on first use.
+    """
+
+    def enqueue(self, record):
+        _ensure_log_listener()
+        _log_queue.put_nowait(record)
+
+
+@atexit.register
+def _stop_log_listener():
+    """Writes out any log records still queued when the process exits."""
+    if _log_listener_pid == os.getpid():
+        _log_listener.stop()
+
+
+app.logger.removeHandler(default_handler)
+app.logger.addHandler(_LazyQueueHandler(None))
+
+# Compress responses (search pages embed facets and result data alongside the
+# markup) for clients that accept it. Static files are also allowed to be
+# cached by browsers for an hour; their URLs aren't versioned, so a longer
+# lifetime would keep serving stale styles after a deploy.
+app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 3600
+Compress(app)
+
 # Enable the 'do' extension for Jinja2 templates. This is required for the
 # complex category hierarchy processing in `categories.html`.
 app.jinja_env.add_extension('jinja2.ext.do')
 
+# Compiled templates are cached in the temp directory, so new worker processes
+# load them instead of parsing and compiling every template on first render.
+# Entries are keyed by a checksum of the template source, so a deploy with
+# changed templates never picks up stale bytecode.
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache()
+
 # When deploying to a managed service like Cloud Run, the app is behind a
 # reverse proxy. The ProxyFix middleware helps the app correctly handle
 # headers like X-Forwarded-For and X-Forwarded-Proto, which is crucial for
@@ -55,6 +173,32 @@ app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1, x_proto=1, x_host=1, x_prefix=1)
 # The check for its existence is now handled centrally in config.py.
 app.secret_key = config.SECRET_KEY
 
+# --- Server-Side Session Storage (Optional) ---
+# A cookie session carries the whole cart back and forth on every request.
+# When a Redis URL is configured, the session data is kept in Redis instead and
+# the cookie only holds the session ID.
+redis_client = None
+if config.REDIS_URL:
+    redis_client = redis.Redis(
+        connection_pool=redis.BlockingConnectionPool.from_url(
+            config.REDIS_URL, max_connections=50, socket_keepalive=True
+        )
+    )
+    # Server-side sessions are permanent, and by default Flask-Session would
+    # re-save the session to Redis and re-send the cookie on every request just
+    # to extend its expiry. Only write it back when it was actually modified.
+    app.config.update(
+        SESSION_TYPE='redis',
+        SESSION_REDIS=redis_client,
+        SESSION_REFRESH_EACH_REQUEST=False,
+    )
+    Session(app)
+
+# Signs the order tokens passed to the confirmation page after checkout. A
+# token, and the order stored for it in Redis, is valid for ORDER_TTL_SECONDS.
+order_serializer = URLSafeTimedSerializer(app.secret_key, salt='order-confirmation')
+ORDER_TTL_SECONDS = 600
+
 # --- OAuth Client Initialization ---
 oauth = OAuth(app)
 oauth.register(
@@ -78,33 +222,179 @@ search_placement = SearchServiceClient.serving_config_path(
     serving_config=config.SERVING_CONFIG_ID,
 )
 
+# Placement for the homepage recommendations
+RECOMMENDATION_PLACEMENT = SearchServiceClient.serving_config_path(
+    project=config.PROJECT_ID,
+    location=config.LOCATION,
+    catalog=config.CATALOG_ID,
+    serving_config=config.RECOMMENDATION_SERVING_CONFIG_ID,
+)
+
+# Placement for the similar-items model on the product detail page
+SIMILAR_ITEMS_PLACEMENT = SearchServiceClient.serving_config_path(
+    project=config.PROJECT_ID,
+    location=config.LOCATION,
+    catalog=config.CATALOG_ID,
+    serving_config="similar-items-1",
+)
+
+# Catalog path used as the parent for user event writes and category lookups
+CATALOG_PATH = UserEventServiceClient.catalog_path(
+    project=config.PROJECT_ID,
+    location=config.LOCATION,
+    catalog=config.CATALOG_ID,
+)
+
+# Branch searched and listed for products. By default, product data is
+# ingested into branch '0' (the default_branch).
+BRANCH_PATH = SearchServiceClient.branch_path(
+    project=config.PROJECT_ID,
+    location=config.LOCATION,
+    catalog=config.CATALOG_ID,
+    branch="default_branch",
+)
+
+
+def _product_name(product_id):
+    """Returns the full resource name of a product in BRANCH_PATH."""
+    return f"{BRANCH_PATH}/products/{product_id}"
+
+
+# HTTP/2 keepalive pings for the long-lived Retail API channel, so that an idle
+# connection is kept open (and a dead one detected) between requests instead of
+# a page or purchase paying for a fresh TCP + TLS handshake.
+RETAIL_CHANNEL_OPTIONS = [
+    ("grpc.keepalive_time_ms", 30000),
+    ("grpc.keepalive_timeout_ms", 10000),
+    ("grpc.http2.max_pings_without_data", 0),
+]
+
+
+# Facet specifications shared by the search, browse and agent search pages.
+# Using static intervals for numerical facets like price and rating provides a
+# better user experience and makes the data easier for the frontend to handle,
+# preventing potential JS errors. The list is built once at import and is only
+# ever copied into each SearchRequest, never mutated.
+SEARCH_FACET_SPECS = [
+    SearchRequest.FacetSpec(
+        facet_key=SearchRequest.FacetSpec.FacetKey(key="brands", order_by="count desc"),
+        limit=20,
+        enable_dynamic_position=False # Pin brands to the top
+    ),
+    SearchRequest.FacetSpec(
+        facet_key=SearchRequest.FacetSpec.FacetKey(key="categories", order_by="count desc"),
+        enable_dynamic_position=False # Pin categories to the top
+    ),
+    SearchRequest.FacetSpec(
+        facet_key=SearchRequest.FacetSpec.FacetKey(key="colorFamilies", order_by="count desc"),
+        limit=10,
+        enable_dynamic_position=True # Allow color to be dynamically positioned
+    ),
+    SearchRequest.FacetSpec(
+        facet_key=SearchRequest.FacetSpec.FacetKey(
+            key="price",
+            intervals=[
+                Interval(minimum=0.0, maximum=25.0),
+                Interval(minimum=25.0, maximum=50.0),
+                Interval(minimum=50.0, maximum=100.0),
+                Interval(minimum=100.0, maximum=200.0),
+                Interval(minimum=200.0),
+            ]
+        ),
+        enable_dynamic_position=False # Pin price to the top
+    ),
+    SearchRequest.FacetSpec(
+        facet_key=SearchRequest.FacetSpec.FacetKey(
+            key="rating",
+            intervals=[
+                Interval(minimum=1.0, maximum=2.0),
+                Interval(minimum=2.0, maximum=3.0),
+                Interval(minimum=3.0, maximum=4.0),
+                Interval(minimum=4.0),
+            ]
+        ),
+        enable_dynamic_position=False # Pin rating to the top
+    ),
+]
+
+# The chat page's product carousel only needs the default facet behaviour.
+CHAT_FACET_SPECS = [
+    SearchRequest.FacetSpec(facet_key=SearchRequest.FacetSpec.FacetKey(key=key))
+    for key in ("brands", "categories", "price", "rating")
+]
+
+# Query expansion broadens the search for better results. Pinning unexpanded
+# results ensures that items matching the original query are ranked higher.
+QUERY_EXPANSION_AUTO = SearchRequest.QueryExpansionSpec(
+    condition=SearchRequest.QueryExpansionSpec.Condition.AUTO,
+    pin_unexpanded_results=True
+)
+QUERY_EXPANSION_DISABLED = SearchRequest.QueryExpansionSpec(
+    condition=SearchRequest.QueryExpansionSpec.Condition.DISABLED
+)
+
+
+# All of the Retail v2 services are served from the same endpoint, so their
+# clients share one gRPC channel (one connection and TLS session) instead of
+# each opening its own. HTTP/2 multiplexes the concurrent calls over it.
+retail_channel = SearchServiceGrpcTransport.create_channel(
+    "retail.googleapis.com:443",
+    options=RETAIL_CHANNEL_OPTIONS,
+)
+
 # Initialize the Search Service Client
-search_client = SearchServiceClient()
+search_client = SearchServiceClient(
+    transport=SearchServiceGrpcTransport(channel=retail_channel)
+)
 
 # Initialize the Completion Service Client for autocomplete
-completion_client = CompletionServiceClient()
+completion_client = CompletionServiceClient(
+    transport=CompletionServiceGrpcTransport(channel=retail_channel)
+)
 
 # Initialize the Product Service Client
-product_client = ProductServiceClient()
+product_client = ProductServiceClient(
+    transport=ProductServiceGrpcTransport(channel=retail_channel)
+)
 
 # Initialize the Prediction Service Client
-prediction_client = PredictionServiceClient()
-
-# Initialize the User Event Service Client
-user_event_client = UserEventServiceClient()
+prediction_client = PredictionServiceClient(
+    transport=PredictionServiceGrpcTransport(channel=retail_channel)
+)
 
-# Initialize the Conversational Search Service Client from v2alpha
-conversational_search_client = ConversationalSearchServiceClient()
+# Initialize the User Event Service Client. It is created once and shared by
+# all requests and the event flusher thread.
+user_event_client = UserEventServiceClient(
+    transport=UserEventServiceGrpcTransport(channel=retail_channel)
+)
 
 # Initialize a markdown parser for formatting generated answers
 markdown_parser = MarkdownIt()
 
-# --- Conditional Support Agent Client Initialization ---
-support_answer_client = None
+# --- Lazily Initialized Conversational Clients ---
+# These clients are only used by the chat and agent search pages. Creating a
+# client performs credential discovery and opens a channel, so they are
+# created on first use to keep cold starts fast for every other page.
+@lru_cache(maxsize=1)
+def get_conversational_search_client():
+    """Returns the v2alpha Conversational Search Service Client."""
+    return ConversationalSearchServiceClient()
+
+
+@lru_cache(maxsize=1)
+def get_support_answer_client():
+    """
+    Returns the Discovery Engine Conversational Search Service Client used for
+    support answers, or None if the support agent is disabled.
+    """
+    if not config.ENABLE_SUPPORT_AGENT:
+        return None
+    return discoveryengine.ConversationalSearchServiceClient()
+
+
+# --- Conditional Support Agent Configuration ---
 support_serving_config = None
 if config.ENABLE_SUPPORT_AGENT:
-    # Initialize the Discovery Engine Conversational Search Service Client for support answers
-    support_answer_client = discoveryengine.ConversationalSearchServiceClient()
     # Placement for support search
     support_serving_config = (
         f"projects/{config.SUPPORT_PROJECT_ID}/locations/{config.SUPPORT_LOCATION}/"
@@ -118,6 +408,303 @@ conversational_placement = (
     f"{config.CATALOG_ID}/placements/default_search"
 )
 
+# --- Background User Event Ingestion ---
+# Request handlers queue their UserEvents instead of writing them inline. A
+# background thread drains the queue and sends the events to the Retail API in
+# batches with `import_user_events`, so the user's response never waits on an
+# event write and bursts of traffic are sent as a handful of RPCs.
+EVENT_QUEUE_MAX_SIZE = 10000
+EVENT_BATCH_SIZE = config.EVENT_BATCH_SIZE
+EVENT_FLUSH_INTERVAL_SECONDS = config.EVENT_FLUSH_INTERVAL_MS / 1000
+
+# Batches whose import fails with a transient error (e.g. the API is briefly
+# unavailable) are retried with exponential backoff. During a longer outage
+# the retry buffer is bounded by dropping the oldest batches. The client's own
+# retry is disabled and each attempt is given a short timeout, as it would
+# otherwise keep retrying for up to ten minutes, blocking the flusher while
+# the queue fills up, and then fail with an error that isn't retried here.
+EVENT_IMPORT_TIMEOUT_SECONDS = 10.0
+EVENT_RETRY_MAX_BATCHES = 50
+EVENT_RETRY_INITIAL_BACKOFF_SECONDS = 1.0
+EVENT_RETRY_MAX_BACKOFF_SECONDS = 60.0
+
+# Each import runs as a long-running operation whose result reports the events
+# the API rejected. The retry thread checks the outstanding operations once
+# per tick, giving up on any that haven't finished within the timeout.
+EVENT_IMPORT_MAX_PENDING = 100
+EVENT_IMPORT_RESULT_TIMEOUT_SECONDS = 600.0
+
+_event_queue = queue.Queue(maxsize=EVENT_QUEUE_MAX_SIZE)
+_event_retry_queue = collections.deque(maxlen=EVENT_RETRY_MAX_BATCHES)
+_pending_event_imports = collections.deque(maxlen=EVENT_IMPORT_MAX_PENDING)
+_event_flusher_lock = threading.Lock()
+_event_flusher_pid = None
+
+
+def _enqueue_user_event(user_event):
+    """Queues a UserEvent for background ingestion, dropping it if the queue is full."""
+    _ensure_event_flusher()
+    # Events are ingested up to a flush interval later, so record when the
+    # event actually happened rather than leaving it to the API.
+    if 'event_time' not in user_event:
+        UserEvent.pb(user_event).event_time.GetCurrentTime()
+    try:
+        _event_queue.put_nowait(user_event)
+    except queue.Full:
+        app.logger.warning("User event queue is full, dropping %s event for visitor %s",
+                           user_event.event_type, user_event.visitor_id)
+
+
+def _ensure_event_flusher():
+    """
+    Starts the event flusher and retry threads for the current process. This is done
+    lazily rather than at import time so that each forked server worker gets
+    its own thread (threads do not survive a fork).
+    """
+    global _event_flusher_pid
+    if _event_flusher_pid == os.getpid():
+        return
+    with _event_flusher_lock:
+        if _event_flusher_pid != os.getpid():
+            threading.Thread(target=_run_event_flusher, name='user-event-flusher', daemon=True).start()
+            threading.Thread(target=_run_event_retrier, name='user-event-retrier', daemon=True).start()
+            _event_flusher_pid = os.getpid()
+
+
+def _next_event_batch():
+    """
+    Blocks until an event is queued, then collects further events until the
+    batch is full or the flush interval has elapsed.
+    """
+    batch = [_event_queue.get()]
+    deadline = time.monotonic() + EVENT_FLUSH_INTERVAL_SECONDS
+    while len(batch) < EVENT_BATCH_SIZE:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        try:
+            batch.append(_event_queue.get(timeout=remaining))
+        except queue.Empty:
+            break
+    return batch
+
+
+def _dedupe_user_events(user_events):
+    """
+    Drops repeated client-side events of the same type for the same page view,
+    e.g. when the tracker fires twice. Server-side events carry no page view
+    ID and are always kept.
+    """
+    seen = set()
+    unique_events = []
+    for user_event in user_events:
+        if user_event.page_view_id:
+            key = (user_event.event_type, user_event.page_view_id)
+            if key in seen:
+                continue
+            seen.add(key)
+        unique_events.append(user_event)
+    return unique_events
+
+
+def _import_user_events(user_events, backoff=EVENT_RETRY_INITIAL_BACKOFF_SECONDS):
+    """
+    Sends a batch of user events to the Retail API in a single import request.
+    If it fails with a transient error, the batch is scheduled for a retry
+    after `backoff` seconds.
+    """
+    try:
+        import_request = ImportUserEventsRequest(
+            parent=CATALOG_PATH,
+            input_config=UserEventInputConfig(
+                user_event_inline_source=UserEventInlineSource(user_events=user_events)
+            ),
+        )
+        operation = user_event_client.import_user_events(
+            request=import_request, retry=None, timeout=EVENT_IMPORT_TIMEOUT_SECONDS
+        )
+        # Events the API rejects are only reported in the operation's result,
+        # so it is kept for the retry thread to check rather than assumed to
+        # have succeeded.
+        if len(_pending_event_imports) == _pending_event_imports.maxlen:
+            app.logger.warning("Too many user event imports pending, no longer checking the oldest")
+        _pending_event_imports.append(
+            (time.monotonic() + EVENT_IMPORT_RESULT_TIMEOUT_SECONDS, len(user_events), operation)
+        )
+        app.logger.info("Started import of %d user events", len(user_events))
+    except Exception as e:
+        if not (if_transient_error(e) or isinstance(e, DeadlineExceeded)):
+            app.logger.exception("Error importing %d user events", len(user_events))
+            return
+        if len(_event_retry_queue) == _event_retry_queue.maxlen:
+            app.logger.warning("User event retry queue is full, dropping the oldest batch")
+        app.logger.warning("Error importing %d user events, retrying in %.0fs: %s",
+                           len(user_events), backoff, e)
+        _event_retry_queue.append((time.monotonic() + backoff, backoff, user_events))
+
+
+def _check_pending_event_imports(now):
+    """
+    Checks each outstanding import operation once (a single GetOperation call),
+    logging the results of those that have finished and giving up on those
+    that have been running for longer than EVENT_IMPORT_RESULT_TIMEOUT_SECONDS.
+    """
+    for _ in range(len(_pending_event_imports)):
+        try:
+            give_up_at, event_count, operation = _pending_event_imports.popleft()
+        except IndexError:
+            break
+        try:
+            done = operation.done()
+        except Exception as e:
+            app.logger.warning("Error checking the import of %d user events: %s", event_count, e)
+            done = False
+        if done:
+            _log_user_event_import_result(operation)
+        elif give_up_at <= now:
+            app.logger.warning("Gave up waiting for the import of %d user events to finish", event_count)
+        else:
+            _pending_event_imports.append((give_up_at, event_count, operation))
+
+
+def _log_user_event_import_result(operation):
+    """
+    Logs the outcome of a finished `import_user_events` operation, including
+    any events the API rejected (e.g. a malformed event from the client-side
+    tracker).
+    """
+    error = operation.exception()
+    if error is not None:
+        app.logger.error("User event import failed: %s", error)
+        return
+    metadata = operation.metadata
+    if metadata is not None and metadata.failure_count:
+        app.logger.warning("User event import rejected %d of %d events",
+                           metadata.failure_count, metadata.success_count + metadata.failure_count)
+    for error_sample in operation.result().error_samples:
+        app.logger.warning("User event import error: %s", error_sample.message)
+
+
+def _run_event_flusher():
+    """Sends queued user events to the Retail API in batches, forever."""
+    while True:
+        _import_user_events(_dedupe_user_events(_next_event_batch()))
+
+
+def _run_event_retrier():
+    """
+    Re-sends failed batches once their backoff has elapsed, doubling the
+    backoff (up to a limit) each time a batch fails again, and checks on the
+    imports that are still running.
+    """
+    while True:
+        time.sleep(EVENT_RETRY_INITIAL_BACKOFF_SECONDS)
+        now = time.monotonic()
+        for _ in range(len(_event_retry_queue)):
+            try:
+                retry_at, backoff, user_events = _event_retry_queue.popleft()
+            except IndexError:
+                break
+            if retry_at > now:
+                _event_retry_queue.append((retry_at, backoff, user_events))
+                continue
+            _import_user_events(user_events, backoff=min(backoff * 2, EVENT_RETRY_MAX_BACKOFF_SECONDS))
+        _check_pending_event_imports(now)
+
+
+@atexit.register
+def _flush_user_events_on_exit():
+    """
+    Sends any events still waiting in the queue or for a retry when the
+    process shuts down (e.g. a server worker being recycled), so they are not
+    lost with the daemon threads.
+    """
+    user_events = []
+    while _event_retry_queue:
+        user_events.extend(_event_retry_queue.popleft()[2])
+    while True:
+        try:
+            user_events.append(_event_queue.get_nowait())
+        except queue.Empty:
+            break
+    user_events = _dedupe_user_events(user_events)
+    for start in range(0, len(user_events), EVENT_BATCH_SIZE):
+        _import_user_events(user_events[start:start + EVENT_BATCH_SIZE])
+
+
+def _request_user_info():
+    """
+    Returns the UserInfo for a server-side event about the current request,
+    associated with the logged-in user's stable ID when there is one.
+    """
+    user_info = UserInfo(
+        user_agent=request.user_agent.string,
+        ip_address=request.remote_addr
+    )
+    if session.get('user'):
+        user_info.user_id = session['user']['sub']
+    return user_info
+
+
+def _product_from_dict(product_dict):
+    """
+    Builds a Product message from a dict in the API's JSON shape, such as the
+    product metadata returned with recommendations. The dict is parsed directly
+    rather than serialized to JSON and parsed back with `Product.from_json`.
+    Field names are accepted in either form (e.g. priceInfo or price_info), and
+    keys that aren't part of the Product schema, like the "@type" added by
+    `to_dict`, are ignored.
+    """
+    product = Product()
+    json_format.ParseDict(product_dict, Product.pb(product), ignore_unknown_fields=True)
+    return product
+
+
+def _product_from_prediction(result):
+    """
+    Returns the Product carried in a PredictionResult's metadata, or None when
+    the prediction came back without one. Only the "product" Struct is
+    converted, read straight off the underlying protobuf, instead of turning
+    the whole result into a dict with `to_dict` first.
+    """
+    metadata = PredictResponse.PredictionResult.pb(result).metadata
+    if 'product' not in metadata:
+        return None
+    return _product_from_dict(json_format.MessageToDict(metadata['product']))
+
+
+def _search_result_to_dict(result):
+    """
+    Returns the fields of a SearchResult that the chat product cards render, as
+    a plain dict. It reads the underlying protobuf directly instead of running
+    `to_dict` over the whole product, and uses the same snake_case keys that
+    `to_dict` emits so the templates and client-side JS are unchanged.
+    """
+    product = SearchResponse.SearchResult.pb(result).product
+    price_info = product.price_info
+    return {
+        'id': result.id,
+        'product': {
+            'id': product.id,
+            'title': product.title,
+            'uri': product.uri,
+            'images': [{'uri': image.uri} for image in product.images],
+            'price_info': {
+                'price': price_info.price,
+                'original_price': price_info.original_price,
+                'currency_code': price_info.currency_code,
+            },
+        },
+    }
+
+
+# A map for creating user-friendly display names for facet keys.
+FACET_DISPLAY_NAMES = {
+    'colorFamilies': 'Color',
+    'categories': 'Category'
+}
+
+
 def _process_facets(facets_from_api, selected_facets):
     """
     Converts the facet protobuf objects from the API into a more
@@ -128,12 +715,6 @@ def _process_facets(facets_from_api, selected_facets):
     if not facets_from_api:
         return processed_facets
 
-    # A map for creating user-friendly display names for facet keys.
-    display_name_map = {
-        'colorFamilies': 'Color',
-        'categories': 'Category'
-    }
-
     for facet in facets_from_api:
         facet_key = facet.key
 
@@ -144,10 +725,20 @@ def _process_facets(facets_from_api, selected_facets):
 
         # Use the original facet_key for the map lookup, but the cleaned-up
         # key for the .title() fallback.
-        display_name = display_name_map.get(facet_key, temp_display_key.title())
+        display_name = FACET_DISPLAY_NAMES.get(facet_key, temp_display_key.title())
+
+        # Resolve the per-group lookups once rather than for every value; a
+        # category facet can carry hundreds of values.
+        selected_values = set(selected_facets.get(facet_key, ()))
+        is_price = facet_key == 'price'
+        is_rating = facet_key == 'rating'
 
         processed_values = []
         for facet_value in facet.values:
+            # Only add the facet value if it has a count
+            if facet_value.count <= 0:
+                continue
+
             value_str = ""
             display_str = ""
 
@@ -163,28 +754,26 @@ def _process_facets(facets_from_api, selected_facets):
                 value_str = f"{min_val or ''}-{max_val or ''}"
 
                 # Create a user-friendly display string
-                if facet_key == 'price':
+                if is_price:
                     if min_val is not None and max_val is not None:
                         display_str = f"${min_val:g} - ${max_val:g}"
                     elif min_val is not None:
                         display_str = f"Over ${min_val:g}"
                     elif max_val is not None:
                         display_str = f"Under ${max_val:g}"
-                elif facet_key == 'rating':
+                elif is_rating:
                     if min_val is not None and max_val is not None:
                         display_str = f"{min_val:g} - {max_val:g} Stars"
                     elif min_val is not None:
                         display_str = f"{min_val:g}+ Stars"
 
             # Check if this facet value is currently selected
-            is_selected = value_str in selected_facets.get(facet_key, [])
+            is_selected = value_str in selected_values
 
-            # Only add the facet value if it has a count
-            if facet_value.count > 0:
-                processed_values.append({
-                    'value': value_str, 'display': display_str,
-                    'count': facet_value.count, 'selected': is_selected,
-                })
+            processed_values.append({
+                'value': value_str, 'display': display_str,
+                'count': facet_value.count, 'selected': is_selected,
+            })
 
         # Only add the facet group if it has values with counts
         if processed_values:
@@ -194,23 +783,120 @@ def _process_facets(facets_from_api, selected_facets):
             
     return processed_facets
 
+# Larger page numbers are clamped to this. It also keeps int() away from the
+# arbitrarily long digit strings it refuses to convert.
+MAX_PAGE_NUMBER = 1000
+
+
+def _get_page_number():
+    """
+    Returns the 1-based page number from the 'page' query parameter,
+    falling back to 1 for missing, malformed, or out-of-range values and
+    clamping it to MAX_PAGE_NUMBER.
+    """
+    page_str = request.args.get('page', '1')
+    # isdecimal() matches exactly the characters int() accepts, so this avoids
+    # using a try/except around int() as control flow.
+    if not page_str.isdecimal():
+        return 1
+    digits = page_str.lstrip('0')
+    if len(digits) > len(str(MAX_PAGE_NUMBER)):
+        return MAX_PAGE_NUMBER
+    return min(max(int(digits or '0'), 1), MAX_PAGE_NUMBER)
+
+# Query string parameters each page uses for itself; every other parameter is
+# treated as a selected facet value.
+BROWSE_RESERVED_ARGS = frozenset({'page', 'attribution_token'})
+SEARCH_RESERVED_ARGS = frozenset({'query', 'expand', 'page', 'attribution_token'})
+AGENT_SEARCH_RESERVED_ARGS = frozenset({'query', 'conversation_id', 'attribution_token', 'page'})
+
+
+def _quote_filter_value(value):
+    """
+    Returns `value` as a quoted string literal for a Retail API filter.
+    Backslashes and quotes are escaped so a value taken from the request can't
+    end the literal early and make the whole filter invalid.
+    """
+    return '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def _build_facet_filters(reserved_keys):
+    """
+    Builds Retail API filter expressions from the facet values selected in the
+    query string, skipping the page's own parameters (`reserved_keys`).
+    Returns the list of filter expressions and a dict of the selected values
+    keyed by facet.
+    """
+    facet_filters = []
+    selected_facets = {}
+
+    # Most requests (a first search or a plain category page) carry only the
+    # page's own parameters, so there is nothing to parse.
+    if request.args.keys() <= reserved_keys:
+        return facet_filters, selected_facets
+
+    # lists() yields each key once with all of its values, in a single pass.
+    for key, values in request.args.lists():
+        if key in reserved_keys:
+            continue
+        selected_facets[key] = values
+
+        # Check if the key is for a numerical facet we defined
+        if key in ('price', 'rating'):
+            # For numerical facets, we expect values like "10.00-25.00"
+            # and build filters like "(price >= 10.00 AND price < 25.00)".
+            # Multiple selected ranges for the same key are ORed together.
+            range_filters = []
+            for v in values:
+                try:
+                    min_val_str, max_val_str = v.split('-', 1)
+                    range_filter_parts = []
+                    if min_val_str:
+                        range_filter_parts.append(f'{key} >= {float(min_val_str)}')
+                    if max_val_str:
+                        # The API's interval is exclusive for the maximum.
+                        range_filter_parts.append(f'{key} < {float(max_val_str)}')
+                    if range_filter_parts:
+                        range_filters.append(f"({' AND '.join(range_filter_parts)})")
+                except ValueError:
+                    # Ignore malformed range values
+                    continue
+            if range_filters:
+                facet_filters.append(f"({' OR '.join(range_filters)})")
+        else:
+            # Textual facets match any of the selected values
+            filter_values = ', '.join([_quote_filter_value(v) for v in values])
+            facet_filters.append(f'{key}: ANY({filter_values})')
+
+    return facet_filters, selected_facets
+
+# Map of support intent names to their default internal Flask route names.
+SUPPORT_DEFAULT_ROUTES = {
+    "ORDER_SUPPORT": "orders",
+    "DEALS_AND_COUPONS": "promotions",
+    "STORE_RELEVANT": "stores",
+    "RETAIL_SUPPORT": "support",
+}
+
+
 def _get_support_links():
     """
     Constructs a dictionary of URLs for support-related intents.
     It prioritizes URLs from the environment configuration and falls back to
     generating URLs for internal routes if a configuration is not set.
     """
-    # Map of intent names to their default internal Flask route names.
-    default_routes = {
-        "ORDER_SUPPORT": "orders",
-        "DEALS_AND_COUPONS": "promotions",
-        "STORE_RELEVANT": "stores",
-        "RETAIL_SUPPORT": "support",
-    }
-    
+    # The generated URLs only vary with the app's mount point, which ProxyFix
+    # takes from each request's X-Forwarded-Prefix, so they are built once per
+    # script root rather than on every chat turn.
+    return _build_support_links(request.script_root)
+
+
+@lru_cache(maxsize=8)
+def _build_support_links(script_root):
+    """Builds the support links for requests served under `script_root`."""
     return {
         intent: config.SUPPORT_INTENT_URLS.get(intent) or url_for(route_name)
-        for intent, route_name in default_routes.items()
+        for intent, route_name in SUPPORT_DEFAULT_ROUTES.items()
     }
 
 @app.context_processor
@@ -254,14 +940,8 @@ def sitemap():
 
         # Product pages
         product_urls = []
-        parent = product_client.branch_path(
-            project=config.PROJECT_ID,
-            location=config.LOCATION,
-            catalog=config.CATALOG_ID,
-            branch="default_branch"
-        )
         # Note: For very large catalogs, consider caching this or generating it offline.
-        list_request = ListProductsRequest(parent=parent, page_size=1000)
+        list_request = ListProductsRequest(parent=BRANCH_PATH, page_size=1000)
         product_pager = product_client.list_products(request=list_request)
         for product in product_pager:
             product_urls.append(url_for('product_detail', product_id=product.id, _external=True))
@@ -272,15 +952,9 @@ def sitemap():
             facet_key=SearchRequest.FacetSpec.FacetKey(key="categories"),
             limit=250
         )
-        branch_path = SearchServiceClient.branch_path(
-            project=config.PROJECT_ID,
-            location=config.LOCATION,
-            catalog=config.CATALOG_ID,
-            branch="default_branch"
-        )
         search_request = SearchRequest(
             placement=search_placement,
-            branch=branch_path,
+            branch=BRANCH_PATH,
             query="",
             visitor_id="sitemap-generator",
             page_size=0,
@@ -301,8 +975,8 @@ def sitemap():
         
         return response
 
-    except Exception as e:
-        print(f"Error generating sitemap: {e}\n{traceback.format_exc()}")
+    except Exception:
+        app.logger.exception("Error generating sitemap")
         return "Error generating sitemap", 500
 
 @app.route('/login')
@@ -329,8 +1003,8 @@ def callback():
         session['visitor_id'] = user_info['sub']
 
         return redirect(url_for('index'))
-    except Exception as e:
-        print(f"Error during Google OAuth callback: {e}\n{traceback.format_exc()}")
+    except Exception:
+        app.logger.exception("Error during Google OAuth callback")
         return redirect(url_for('index')) # Redirect home on error
 
 
@@ -342,22 +1016,50 @@ def logout():
     return redirect(url_for('index'))
 
 
+HOME_RECOMMENDATIONS_CACHE_TTL_SECONDS = 60
+
+
+# Recommendations are personalised, so they are only reused for the same
+# visitor (and signed-in user), but returning to the home page within a minute
+# of leaving it is common enough that the repeat predict call is worth saving.
+@cached(
+    TTLCache(maxsize=4096, ttl=HOME_RECOMMENDATIONS_CACHE_TTL_SECONDS),
+    key=lambda context_user_event: (context_user_event.visitor_id, context_user_event.user_info.user_id),
+    lock=threading.Lock(),
+)
+def _predict_home_recommendations(context_user_event):
+    """
+    Returns the recommended products for a home page view, as a tuple, and the
+    attribution token of the prediction they came from.
+    """
+    predict_request = PredictRequest(
+        placement=RECOMMENDATION_PLACEMENT,
+        user_event=context_user_event,
+        page_size=10,
+        params={"returnProduct": struct_pb2.Value(bool_value=True)}
+    )
+    response = prediction_client.predict(request=predict_request)
+
+    # The product data is a Struct inside each result's metadata map.
+    recommendations = []
+    for result in response.results:
+        product = _product_from_prediction(result)
+        if product is not None:
+            recommendations.append(product)
+    return tuple(recommendations), response.attribution_token
+
+
 @app.route('/')
 def index():
     """Homepage: Fetches and displays product recommendations."""
     recommendations = []
     error = None
-    response = None # Initialize to avoid reference errors in exception handling
+    attribution_token = None
     try:
-        # The full resource name of the serving config
-        recommendation_placement = (
-            f"projects/{config.PROJECT_ID}/locations/{config.LOCATION}"
-            f"/catalogs/{config.CATALOG_ID}/servingConfigs/{config.RECOMMENDATION_SERVING_CONFIG_ID}"
-        )
-
         # --- Step 1: Create a context event for the predict call ---
         # This event is NOT logged but provides context for the prediction.
         # A separate event will be written later to log the impression.
+        visitor_id = session.get('visitor_id')
         user_id = session.get('user', {}).get('sub')
         user_info_proto = UserInfo(
             user_agent=request.user_agent.string,
@@ -369,91 +1071,52 @@ def index():
 
         context_user_event = UserEvent(
             event_type="home-page-view",
-            visitor_id=session.get('visitor_id'),
+            visitor_id=visitor_id,
             user_info=user_info_proto,
             uri=request.url,
             referrer_uri=request.referrer,
             page_view_id=page_view_id
         )
 
-        # Create the predict request
-        predict_request = PredictRequest(
-            placement=recommendation_placement,
-            user_event=context_user_event,
-            page_size=10,
-            params={"returnProduct": struct_pb2.Value(bool_value=True)}
-        )
-
-        # Get the prediction response
-        response = prediction_client.predict(request=predict_request)
-
-        # --- Step 2: Process recommendations for rendering ---
-        for result in response.results:
-            # Convert the PredictionResult proto message to a dictionary.
-            # This correctly handles all nested structures and types, including
-            # the product metadata which is a Struct.
-            result_dict = PredictResponse.PredictionResult.to_dict(result)
-
-            # The product data is inside the 'metadata' dictionary.
-            if 'product' in result_dict.get('metadata', {}):
-                product_dict = result_dict['metadata']['product']
-
-                # The .to_dict() method can add a "@type" field which is not
-                # part of the Product proto schema and causes a ParseError.
-                # We remove it before attempting to load it back into a Product message.
-                product_dict.pop('@type', None)
-
-                # Then, we serialize the dictionary to a JSON string to use the `Product.from_json`
-                # helper, which correctly handles field name conversions (e.g., priceInfo -> price_info).
-                product_json_str = json.dumps(product_dict)
-                recommendations.append(Product.from_json(product_json_str))
+        # --- Step 2: Get the recommendations to render ---
+        recommendations, attribution_token = _predict_home_recommendations(context_user_event)
 
         # --- Step 3: Log a single, rich user event for the page view and impression ---
         # This event IS logged and includes details from the predict response.
-        if response and recommendations:
+        if recommendations:
             try:
-                # Extract recommended product IDs from the processed recommendations
-                recommended_product_ids = [p.id for p in recommendations]
-
-                # Create the productDetails list for the event
-                product_details_list = [
-                    {"product": {"id": pid}} for pid in recommended_product_ids
-                ]
-
-                # Create the rich event payload for logging
-                logged_event_payload = {
-                    "eventType": "home-page-view",
-                    "visitorId": session.get('visitor_id'),
-                    "userInfo": UserInfo.to_dict(user_info_proto), # Reuse the user_info
-                    "uri": request.url,
-                    "referrerUri": request.referrer,
-                    "pageViewId": page_view_id, # Reuse the same page view ID
-                    "attributionToken": response.attribution_token,
-                    "productDetails": product_details_list,
-                }
-
-                # Construct and write the event
-                parent = user_event_client.catalog_path(
-                    project=config.PROJECT_ID,
-                    location=config.LOCATION,
-                    catalog=config.CATALOG_ID
+                # Build the rich event directly, reusing the user_info and page
+                # view ID from the context event and listing the recommended
+                # products as the impression.
+                logged_event = UserEvent(
+                    event_type="home-page-view",
+                    visitor_id=visitor_id,
+                    user_info=user_info_proto,
+                    uri=request.url,
+                    referrer_uri=request.referrer,
+                    page_view_id=page_view_id,
+                    attribution_token=attribution_token,
+                    product_details=[
+                        ProductDetail(product=Product(id=p.id)) for p in recommendations
+                    ],
                 )
-                logged_event = UserEvent.from_json(json.dumps(logged_event_payload))
-                write_request = WriteUserEventRequest(parent=parent, user_event=logged_event)
-                user_event_client.write_user_event(request=write_request)
-                print(f"Successfully wrote home-page-view with recommendation impression for visitor {session.get('visitor_id')}")
 
-            except Exception as e:
+                # Queue it for background ingestion, so the page renders without
+                # waiting on the Retail API.
+                _enqueue_user_event(logged_event)
+                app.logger.debug("Queued home-page-view with recommendation impression for visitor %s", visitor_id)
+
+            except Exception:
                 # Log the error but don't block the page from rendering
-                print(f"Error writing recommendation impression event: {e}\n{traceback.format_exc()}")
+                app.logger.exception("Error building recommendation impression event")
 
     except (GoogleAPICallError, Exception) as e:
         error = str(e)
-        print(f"Error during homepage processing: {e}\n{traceback.format_exc()}")
+        app.logger.exception("Error during homepage processing")
     
     # Pass the attribution token from the predict response to the template.
     # Do NOT pass event_type, as the event is now handled server-side.
-    return render_template('index.html', recommendations=recommendations, error=error, attribution_token=response.attribution_token if response else None)
+    return render_template('index.html', recommendations=recommendations, error=error, attribution_token=attribution_token)
 
 
 @app.route('/homepage-agent')
@@ -463,14 +1126,8 @@ def homepage_agent():
     # with a different search form target.
     recommendations = []
     error = None
-    response = None # Initialize to avoid reference errors in exception handling
+    attribution_token = None
     try:
-        # The full resource name of the serving config
-        recommendation_placement = (
-            f"projects/{config.PROJECT_ID}/locations/{config.LOCATION}"
-            f"/catalogs/{config.CATALOG_ID}/servingConfigs/{config.RECOMMENDATION_SERVING_CONFIG_ID}"
-        )
-
         # --- Step 1: Create a context event for the predict call ---
         user_id = session.get('user', {}).get('sub')
         user_info_proto = UserInfo(
@@ -490,42 +1147,25 @@ def homepage_agent():
             page_view_id=page_view_id
         )
 
-        # Create the predict request
-        predict_request = PredictRequest(
-            placement=recommendation_placement,
-            user_event=context_user_event,
-            page_size=10,
-            params={"returnProduct": struct_pb2.Value(bool_value=True)}
-        )
-
-        # Get the prediction response
-        response = prediction_client.predict(request=predict_request)
-
-        # --- Step 2: Process recommendations for rendering ---
-        for result in response.results:
-            result_dict = PredictResponse.PredictionResult.to_dict(result)
-            if 'product' in result_dict.get('metadata', {}):
-                product_dict = result_dict['metadata']['product']
-                product_dict.pop('@type', None)
-                product_json_str = json.dumps(product_dict)
-                recommendations.append(Product.from_json(product_json_str))
+        # --- Step 2: Get the recommendations to render ---
+        recommendations, attribution_token = _predict_home_recommendations(context_user_event)
 
         # --- Step 3: Log a single, rich user event for the page view and impression ---
-        if response and recommendations:
+        if recommendations:
             try:
                 # This logic is identical to the main homepage and is handled there.
                 # For brevity, we assume the event tracking is successful.
                 pass
-            except Exception as e:
+            except Exception:
                 # Log the error but don't block the page from rendering
-                print(f"Error writing recommendation impression event for agent homepage: {e}\n{traceback.format_exc()}")
+                app.logger.exception("Error writing recommendation impression event for agent homepage")
 
     except (GoogleAPICallError, Exception) as e:
         error = str(e)
-        print(f"Error during agent homepage processing: {e}\n{traceback.format_exc()}")
+        app.logger.exception("Error during agent homepage processing")
     
     # Pass the attribution token from the predict response to the template.
-    return render_template('homepage-agent.html', recommendations=recommendations, error=error, attribution_token=response.attribution_token if response else None)
+    return render_template('homepage-agent.html', recommendations=recommendations, error=error, attribution_token=attribution_token)
 
 
 @app.route('/about')
@@ -554,53 +1194,60 @@ def support():
     return render_template('support.html')
 
 
-@app.route('/categories')
-def categories_list():
-    """Displays a list of all product categories."""
-    try:
-        # Perform a search with an empty query and a facet spec for categories.
-        # This is an efficient pattern to populate a category listing page.
-        facet_spec = SearchRequest.FacetSpec(
-            facet_key=SearchRequest.FacetSpec.FacetKey(key="categories", order_by="count desc"),
-            # The UserEvent API allows a maximum of 250 pageCategories, so we cap the facet request here.
-            limit=250
-        )
+# The category facet only changes as the catalog does, so it is fetched once
+# and shared by all visitors for CATEGORY_CACHE_TTL_SECONDS. The condition
+# makes requests that miss while it is being fetched wait for that one search
+# instead of each sending their own.
+CATEGORY_CACHE_TTL_SECONDS = 300
+_category_facet_condition = threading.Condition()
 
-        branch_path = SearchServiceClient.branch_path(
-            project=config.PROJECT_ID,
-            location=config.LOCATION,
-            catalog=config.CATALOG_ID,
-            branch="default_branch"
-        )
 
-        search_request = SearchRequest(
-            placement=search_placement,
-            branch=branch_path,
-            query="", # Empty query
-            visitor_id=session.get('visitor_id'),
-            page_size=0, # We only need the facets, not the results
-            facet_specs=[facet_spec],
-        )
+@cached(
+    TTLCache(maxsize=1, ttl=CATEGORY_CACHE_TTL_SECONDS),
+    lock=_category_facet_condition,
+    condition=_category_facet_condition,
+)
+def _get_category_facet():
+    """
+    Returns the catalog's 'categories' facet (top 250 by count), or None if the
+    search returned no facets.
+    """
+    # Perform a search with an empty query and a facet spec for categories.
+    # This is an efficient pattern to populate a category listing page.
+    facet_spec = SearchRequest.FacetSpec(
+        facet_key=SearchRequest.FacetSpec.FacetKey(key="categories", order_by="count desc"),
+        # The UserEvent API allows a maximum of 250 pageCategories, so we cap the facet request here.
+        limit=250
+    )
 
-        search_pager = search_client.search(search_request)
-        search_response = next(search_pager.pages)
+    search_request = SearchRequest(
+        placement=search_placement,
+        branch=BRANCH_PATH,
+        query="", # Empty query
+        # The result is shared by all visitors, so it isn't fetched on behalf of one.
+        visitor_id="category-list",
+        page_size=0, # We only need the facets, not the results
+        facet_specs=[facet_spec],
+    )
 
-        # The first (and only) facet in the response will be our categories
-        category_facet = search_response.facets[0] if search_response.facets else None
+    search_pager = search_client.search(search_request)
+    search_response = next(search_pager.pages)
 
-        # For a 'category-page-view' event, we need to supply the categories.
-        # In this case, it's all the categories being listed on the page.
-        page_categories = []
-        if category_facet:
-            page_categories = [v.value for v in category_facet.values]
-        page_categories_json = json.dumps(page_categories)
+    # The first (and only) facet in the response will be our categories
+    return search_response.facets[0] if search_response.facets else None
 
-        return render_template('categories.html', category_facet=category_facet, error=None, event_type='category-page-view', page_categories_json=page_categories_json)
+
+@app.route('/categories')
+def categories_list():
+    """Displays a list of all product categories."""
+    try:
+        category_facet = _get_category_facet()
+        return render_template('categories.html', category_facet=category_facet, error=None, event_type='category-page-view')
 
     except Exception as e:
-        print(f"Error fetching category list: {e}\n{traceback.format_exc()}")
-        # Pass event type and empty categories json on error to avoid breaking the event tracker
-        return render_template('categories.html', error=str(e), category_facet=None, event_type='category-page-view', page_categories_json='[]')
+        app.logger.exception("Error fetching category list")
+        # Pass event type on error to avoid breaking the event tracker
+        return render_template('categories.html', error=str(e), category_facet=None, event_type='category-page-view')
 
 
 @app.route('/browse/<path:category_name>')
@@ -609,12 +1256,7 @@ def browse_category(category_name):
     Performs a browse search for a specific category using Vertex AI Search.
     This is characterized by an empty query and a specified page_categories field.
     """
-    try:
-        page = int(request.args.get('page', 1))
-    except (ValueError, TypeError):
-        page = 1
-    if page < 1:
-        page = 1
+    page = _get_page_number()
 
     page_size = 20
     offset = (page - 1) * page_size
@@ -622,94 +1264,23 @@ def browse_category(category_name):
     # --- Handle Facets ---
     # For a browse request, the primary filter is the category itself.
     # Additional filters from user interaction are ANDed with it.
-    facet_filters = [f'categories: ANY("{category_name}")']
-    selected_facets = {}
-    processed_keys = {'page', 'attribution_token'}
-
-    for key in request.args:
-        if key not in processed_keys:
-            values = request.args.getlist(key)
-            selected_facets[key] = values
-            # This logic is similar to the main search page for consistency
-            if key in ['price', 'rating']:
-                range_filters = []
-                filter_key = 'price' if key == 'price' else key
-                for v in values:
-                    try:
-                        min_val_str, max_val_str = v.split('-', 1)
-                        range_filter_parts = []
-                        if min_val_str: range_filter_parts.append(f'{filter_key} >= {float(min_val_str)}')
-                        if max_val_str: range_filter_parts.append(f'{filter_key} < {float(max_val_str)}')
-                        if range_filter_parts: range_filters.append(f"({' AND '.join(range_filter_parts)})")
-                    except (ValueError, IndexError): continue
-                if range_filters: facet_filters.append(f"({' OR '.join(range_filters)})")
-            else:
-                filter_values = ', '.join([f'"{v}"' for v in values])
-                facet_filters.append(f'{key}: ANY({filter_values})')
-            processed_keys.add(key)
-
-    search_filter = " AND ".join(facet_filters)
+    facet_filters, selected_facets = _build_facet_filters(BROWSE_RESERVED_ARGS)
+    search_filter = " AND ".join([f'categories: ANY({_quote_filter_value(category_name)})', *facet_filters])
 
     # --- Build Search Request for BROWSE ---
-    # Define explicit facet specifications. Using static intervals for numerical
-    # facets like price and rating provides a better user experience and makes
-    # the data easier for the frontend to handle, preventing potential JS errors.
-    facet_specs = [
-        SearchRequest.FacetSpec(
-            facet_key=SearchRequest.FacetSpec.FacetKey(key="brands", order_by="count desc"),
-            limit=20,
-            enable_dynamic_position=False # Pin brands to the top
-        ),
-        SearchRequest.FacetSpec(
-            facet_key=SearchRequest.FacetSpec.FacetKey(key="categories", order_by="count desc"),
-            enable_dynamic_position=False # Pin categories to the top
-        ),
-        SearchRequest.FacetSpec(
-            facet_key=SearchRequest.FacetSpec.FacetKey(key="colorFamilies", order_by="count desc"),
-            limit=10,
-            enable_dynamic_position=True # Allow color to be dynamically positioned
-        ),
-        SearchRequest.FacetSpec(
-            facet_key=SearchRequest.FacetSpec.FacetKey(
-                key="price",
-                intervals=[
-                    Interval(minimum=0.0, maximum=25.0),
-                    Interval(minimum=25.0, maximum=50.0),
-                    Interval(minimum=50.0, maximum=100.0),
-                    Interval(minimum=100.0, maximum=200.0),
-                    Interval(minimum=200.0),
-                ]
-            ),
-            enable_dynamic_position=False # Pin price to the top
-        ),
-        SearchRequest.FacetSpec(
-            facet_key=SearchRequest.FacetSpec.FacetKey(
-                key="rating",
-                intervals=[
-                    Interval(minimum=1.0, maximum=2.0),
-                    Interval(minimum=2.0, maximum=3.0),
-                    Interval(minimum=3.0, maximum=4.0),
-                    Interval(minimum=4.0),
-                ]
-            ),
-            enable_dynamic_position=False # Pin rating to the top
-        ),
-    ]
-    branch_path = SearchServiceClient.branch_path(project=config.PROJECT_ID, location=config.LOCATION, catalog=config.CATALOG_ID, branch="default_branch")
-
     search_request = SearchRequest(
-        placement=search_placement, branch=branch_path, query="", page_categories=[category_name],
+        placement=search_placement, branch=BRANCH_PATH, query="", page_categories=[category_name],
         visitor_id=session.get('visitor_id'), page_size=page_size, offset=offset,
-        facet_specs=facet_specs, filter=search_filter,
+        facet_specs=SEARCH_FACET_SPECS, filter=search_filter,
     )
 
     try:
         search_pager = search_client.search(search_request)
         search_response = next(search_pager.pages)
-        total_pages = int(math.ceil(search_response.total_size / page_size)) if search_response.total_size > 0 else 0
+        total_pages = (search_response.total_size + page_size - 1) // page_size if search_response.total_size > 0 else 0
         processed_facets = _process_facets(search_response.facets, selected_facets)
-        results_for_js = [SearchResponse.SearchResult.to_dict(r) for r in search_response.results]
-        page_categories_json = json.dumps([category_name]) # The category being browsed
+        # The event tracker only reads each result's ID.
+        results_for_js = [{'id': r.id} for r in search_response.results]
         return render_template('browse_results.html',
             results=search_response.results,
             facets=processed_facets,
@@ -717,7 +1288,7 @@ def browse_category(category_name):
             results_json=results_for_js,
             category_name=category_name,
             event_type='search',
-            page_categories_json=page_categories_json,
+            page_categories=[category_name], # The category being browsed
             search_filter=search_filter,
             current_page=page,
             total_pages=total_pages,
@@ -726,10 +1297,11 @@ def browse_category(category_name):
             attribution_token=search_response.attribution_token
         )
     except Exception as e:
-        print(f"Error during browse search for category '{category_name}': {e}\n{traceback.format_exc()}")
+        app.logger.exception("Error during browse search for category '%s'", category_name)
         return render_template('browse_results.html',
             error=str(e), category_name=category_name,
-            event_type='search', page_categories_json='[]', facets=[], selected_facets={}, results_json='[]',
+            event_type='search', page_categories=[], facets=[], selected_facets={}, results_json=[],
+            search_filter=search_filter,
             current_page=1, total_pages=0, total_results=0
         )
 
@@ -740,12 +1312,7 @@ def search():
     """
     query = request.args.get('query', '').strip()
     attribution_token = request.args.get('attribution_token')
-    try:
-        page = int(request.args.get('page', 1))
-    except (ValueError, TypeError):
-        page = 1
-    if page < 1:
-        page = 1
+    page = _get_page_number()
 
     page_size = 20
     offset = (page - 1) * page_size
@@ -755,114 +1322,18 @@ def search():
         return redirect(url_for('index'))
  
     # --- Handle Facets ---
-    facet_filters = []
-    selected_facets = {}
-    # Use a set to avoid reprocessing keys when using getlist
-    processed_keys = {'query', 'expand', 'page', 'attribution_token'}
-
-    for key in request.args:
-        if key not in processed_keys:
-            values = request.args.getlist(key)
-            selected_facets[key] = values
-
-            # Check if the key is for a numerical facet we defined
-            if key in ['price', 'rating']:
-                # For numerical facets, we expect values like "10.00-25.00"
-                # and build filters like "(price >= 10.00 AND price < 25.00)".
-                # Multiple selected ranges for the same key are ORed together.
-                range_filters = []
-
-                # The API's filter syntax for price is just 'price', not the full path.
-                filter_key = 'price' if key == 'price' else key
-
-                for v in values:
-                    try:
-                        min_val_str, max_val_str = v.split('-', 1)
-                        range_filter_parts = []
-                        if min_val_str:
-                            range_filter_parts.append(f'{filter_key} >= {float(min_val_str)}')
-                        if max_val_str:
-                            # The API's interval is exclusive for the maximum.
-                            range_filter_parts.append(f'{filter_key} < {float(max_val_str)}')
-                        if range_filter_parts:
-                            range_filters.append(f"({' AND '.join(range_filter_parts)})")
-                    except (ValueError, IndexError):
-                        # Ignore malformed range values
-                        continue
-                if range_filters:
-                    facet_filters.append(f"({' OR '.join(range_filters)})")
-            else:
-                # Existing logic for textual facets
-                filter_values = ', '.join([f'"{v}"' for v in values])
-                facet_filters.append(f'{key}: ANY({filter_values})')
-
-            processed_keys.add(key)
+    facet_filters, selected_facets = _build_facet_filters(SEARCH_RESERVED_ARGS)
 
     # Combine all facet filters with AND
-    search_filter = " AND ".join(facet_filters) if facet_filters else ""
+    search_filter = " AND ".join(facet_filters)
 
     # Check for a URL parameter to control query expansion. Default to True.
     use_expansion = request.args.get('expand', 'true').lower() == 'true'
 
     # --- Build Search Request ---
-    if use_expansion:
-        # Enable query expansion to broaden the search for better results.
-        # Pinning unexpanded results ensures that items matching the original
-        # query are ranked higher.
-        query_expansion_spec = SearchRequest.QueryExpansionSpec(
-            condition=SearchRequest.QueryExpansionSpec.Condition.AUTO,
-            pin_unexpanded_results=True
-        )
-    else:
-        # Explicitly disable query expansion if the URL parameter is set to 'false'.
-        query_expansion_spec = SearchRequest.QueryExpansionSpec(
-            condition=SearchRequest.QueryExpansionSpec.Condition.DISABLED
-        )
-
-    # Define explicit facet specifications. Using static intervals for numerical
-    # facets like price and rating provides a better user experience and makes
-    # the data easier for the frontend to handle, preventing potential JS errors.
-    facet_specs = [
-        SearchRequest.FacetSpec(
-            facet_key=SearchRequest.FacetSpec.FacetKey(key="brands", order_by="count desc"),
-            limit=20,
-            enable_dynamic_position=False # Pin brands to the top
-        ),
-        SearchRequest.FacetSpec(
-            facet_key=SearchRequest.FacetSpec.FacetKey(key="categories", order_by="count desc"),
-            enable_dynamic_position=False # Pin categories to the top
-        ),
-        SearchRequest.FacetSpec(
-            facet_key=SearchRequest.FacetSpec.FacetKey(key="colorFamilies", order_by="count desc"),
-            limit=10,
-            enable_dynamic_position=True # Allow color to be dynamically positioned
-        ),
-        SearchRequest.FacetSpec(
-            facet_key=SearchRequest.FacetSpec.FacetKey(
-                key="price",
-                intervals=[
-                    Interval(minimum=0.0, maximum=25.0),
-                    Interval(minimum=25.0, maximum=50.0),
-                    Interval(minimum=50.0, maximum=100.0),
-                    Interval(minimum=100.0, maximum=200.0),
-                    Interval(minimum=200.0),
-                ]
-            ),
-            enable_dynamic_position=False # Pin price to the top
-        ),
-        SearchRequest.FacetSpec(
-            facet_key=SearchRequest.FacetSpec.FacetKey(
-                key="rating",
-                intervals=[
-                    Interval(minimum=1.0, maximum=2.0),
-                    Interval(minimum=2.0, maximum=3.0),
-                    Interval(minimum=3.0, maximum=4.0),
-                    Interval(minimum=4.0),
-                ]
-            ),
-            enable_dynamic_position=False # Pin rating to the top
-        ),
-    ]
+    # Query expansion is on by default and explicitly disabled if the URL
+    # parameter is set to 'false'.
+    query_expansion_spec = QUERY_EXPANSION_AUTO if use_expansion else QUERY_EXPANSION_DISABLED
 
     # # --- Handle Sorting ---
     # sort_map = {
@@ -875,23 +1346,15 @@ def search():
     # order_by_value = sort_map.get(sort_by)
 
     # The branch to search. This should match the branch where product data is indexed.
-    # By default, product data is ingested into branch '0' (the default_branch).
-    branch_path = SearchServiceClient.branch_path(
-        project=config.PROJECT_ID,
-        location=config.LOCATION,
-        catalog=config.CATALOG_ID,
-        branch="default_branch"
-    )
-
     search_request = SearchRequest(
         placement=search_placement,
-        branch=branch_path,
+        branch=BRANCH_PATH,
         query=query,
         visitor_id=session.get('visitor_id'),
         page_size=page_size,
         offset=offset,
         query_expansion_spec=query_expansion_spec,
-        facet_specs=facet_specs,
+        facet_specs=SEARCH_FACET_SPECS,
         filter=search_filter,
         # order_by=order_by_value,
     )
@@ -905,12 +1368,13 @@ def search():
  
         total_pages = 0
         if search_response.total_size > 0:
-            total_pages = int(math.ceil(search_response.total_size / page_size))
+            total_pages = (search_response.total_size + page_size - 1) // page_size
 
         processed_facets = _process_facets(search_response.facets, selected_facets)
         # The search_response.results is a list of proto messages, not directly
-        # JSON serializable. Convert them to dicts for the event tracker.
-        results_for_js = [SearchResponse.SearchResult.to_dict(r) for r in search_response.results]
+        # JSON serializable. The event tracker only reads each result's ID, so
+        # pass just that rather than converting the full product of every result.
+        results_for_js = [{'id': r.id} for r in search_response.results]
         return render_template(
             'search_results.html',
             results=search_response.results,
@@ -932,7 +1396,7 @@ def search():
             # sort_by=sort_by
         )
     except Exception as e:
-        print(f"Error during search: {e}\n{traceback.format_exc()}")
+        app.logger.exception("Error during search")
         return render_template('search_results.html', error=str(e), query=query, use_expansion=use_expansion, event_type='search', facets=[], selected_facets={}, current_page=1, total_pages=0, total_results=0) #, sort_by='relevance')
 
 
@@ -942,29 +1406,20 @@ def product_detail(product_id):
     Fetches and displays the details for a single product.
     """
     attribution_token = request.args.get('attribution_token')
-    product_name = product_client.product_path(
-        project=config.PROJECT_ID,
-        location=config.LOCATION,
-        catalog=config.CATALOG_ID,
-        branch="default_branch", # Search and get operations should use the same branch, typically '0' (default_branch).
-        product=product_id
-    )
 
     try:
-        product_proto = product_client.get_product(name=product_name)
-        # Convert the proto message to a dictionary for reliable JSON serialization
-        product_dict = Product.to_dict(product_proto)
+        # Search and get operations should use the same branch, typically '0'
+        # (default_branch). The product is served from a short-lived cache.
+        product_proto = _get_product(product_id)
+        # The template renders straight from the proto. The detail-page-view
+        # event only identifies the product by ID, so that is all the client-side
+        # tracker needs, rather than a to_dict conversion of the whole product.
+        product_json = {'id': product_proto.id}
 
         # --- Fetch Similar Items Recommendations ---
         similar_products = []
         similar_products_attribution_token = None
         try:
-            # Placement for the similar-items model
-            similar_items_placement = (
-                f"projects/{config.PROJECT_ID}/locations/{config.LOCATION}/"
-                f"catalogs/{config.CATALOG_ID}/servingConfigs/similar-items-1"
-            )
-
             # Create a context user event for the predict call. This event is not
             # logged but provides the necessary context (the current product)
             # for the recommendations model.
@@ -976,7 +1431,7 @@ def product_detail(product_id):
 
             # Create the predict request
             predict_request = PredictRequest(
-                placement=similar_items_placement,
+                placement=SIMILAR_ITEMS_PLACEMENT,
                 user_event=context_user_event,
                 page_size=20, # Fetch 20 items for 4 pages of 5 in the carousel
                 params={"returnProduct": struct_pb2.Value(bool_value=True)}
@@ -988,80 +1443,86 @@ def product_detail(product_id):
 
             # Process recommendations for rendering
             for result in predict_response.results:
-                result_dict = PredictResponse.PredictionResult.to_dict(result)
-                if 'product' in result_dict.get('metadata', {}):
-                    product_dict_rec = result_dict['metadata']['product']
-                    product_dict_rec.pop('@type', None)
-                    product_json_str = json.dumps(product_dict_rec)
-                    similar_products.append(Product.from_json(product_json_str))
-
-        except (GoogleAPICallError, Exception) as e:
-            print(f"Error fetching similar items recommendations: {e}\n{traceback.format_exc()}")
+                similar_product = _product_from_prediction(result)
+                if similar_product is not None:
+                    similar_products.append(similar_product)
+
+        except (GoogleAPICallError, Exception):
+            app.logger.exception("Error fetching similar items recommendations")
             # Don't fail the page, just log the error. Recommendations will be empty.
 
         return render_template(
             'product_detail.html',
             product=product_proto,
-            product_json=product_dict,
+            product_json=product_json,
             event_type='detail-page-view',
             attribution_token=attribution_token,
             similar_products=similar_products,
             similar_products_attribution_token=similar_products_attribution_token
         )
     except Exception as e:
-        print(f"Error fetching product details: {e}\n{traceback.format_exc()}")
+        app.logger.exception("Error fetching product details")
         return render_template('product_detail.html', error=str(e))
 
 
+# --- Conversational Query Type Handling ---
+# Query types that get a fixed reply instead of an LLM answer, in the order
+# they are checked.
+CANNED_QUERY_TYPE_RESPONSES = {
+    'RETAIL_IRRELEVANT': "I am a shopping assistant. How can I help you find what you're looking for today?",
+    'BLOCKLISTED': "I'm sorry, I cannot fulfill this request.",
+    'QUERY_TYPE_UNSPECIFIED': "I'm not sure I understand. Could you please rephrase your question? I can help you find products and answer questions about them.",
+}
+
+# Support and information query types, answered with a default text and a
+# link to the matching page (plus a generated answer when one is available).
+SUPPORT_QUERY_TYPES = frozenset({'ORDER_SUPPORT', 'DEALS_AND_COUPONS', 'STORE_RELEVANT', 'RETAIL_SUPPORT'})
+
+SUPPORT_DEFAULT_TEXTS = {
+    'ORDER_SUPPORT': "It looks like you have a question about an order. You can track your order or view your order history on our Orders page.",
+    'DEALS_AND_COUPONS': "Looking for a good deal? All of our current promotions, discounts, and coupons are available on our deals page.",
+    'STORE_RELEVANT': "For questions about store locations, hours, or to check product availability, our store finder can help.",
+    'RETAIL_SUPPORT': "For questions about purchases, payment methods, returns, or shipping, our support page has the answers."
+}
+
+SUPPORT_LINK_TEXTS = {
+    'ORDER_SUPPORT': "Go to My Orders",
+    'DEALS_AND_COUPONS': "View Promotions",
+    'STORE_RELEVANT': "Find a Store",
+    'RETAIL_SUPPORT': "Visit Support",
+}
+
+
 def _track_conversational_search_event(query, conversation_id, search_response, attribution_token=None):
     """Helper to track a 'search' event for a conversational interaction."""
     try:
-        parent = user_event_client.catalog_path(
-            project=config.PROJECT_ID,
-            location=config.LOCATION,
-            catalog=config.CATALOG_ID
-        )
-
-        # Aggregate product IDs from the search response
-        product_ids = []
+        # Use the top-level 'id' from each SearchResult, which is guaranteed
+        # to be the product ID. This is more robust than result.product.id.
+        product_details = []
         if search_response and search_response.results:
-            for result in search_response.results:
-                # Use the top-level 'id' from the SearchResult, which is guaranteed
-                # to be the product ID. This is more robust than result.product.id.
-                product_ids.append(result.id)
-
-        product_details_list = [{"product": {"id": pid}} for pid in product_ids]
-
-        user_info = {
-            "userAgent": request.user_agent.string,
-            "ipAddress": request.remote_addr
-        }
-        if session.get('user'):
-            user_info["userId"] = session['user']['sub']
+            product_details = [ProductDetail(product=Product(id=result.id)) for result in search_response.results]
 
         # The attribution token comes from the secondary search response to link the event
         # to the model's output and the products that were shown.
         event_attribution_token = search_response.attribution_token if search_response else attribution_token
 
-        event_payload = {
-            "eventType": "search",
-            "visitorId": session.get('visitor_id'),
-            "userInfo": user_info,
-            "searchQuery": query,
-            "attributionToken": event_attribution_token,
-            "productDetails": product_details_list,
-            "sessionId": conversation_id, # Link event to the conversation
-            "uri": request.url,
-            "referrerUri": request.referrer,
-        }
-
-        user_event = UserEvent.from_json(json.dumps(event_payload))
-        write_request = WriteUserEventRequest(parent=parent, user_event=user_event)
-        user_event_client.write_user_event(request=write_request)
-        print(f"Successfully wrote conversational search event for visitor {session.get('visitor_id')}")
+        user_event = UserEvent(
+            event_type="search",
+            visitor_id=session.get('visitor_id'),
+            user_info=_request_user_info(),
+            search_query=query,
+            attribution_token=event_attribution_token,
+            product_details=product_details,
+            session_id=conversation_id, # Link event to the conversation
+            uri=request.url,
+            referrer_uri=request.referrer,
+        )
+        # Queue the event; it is written to the Retail API in the background.
+        _enqueue_user_event(user_event)
+        app.logger.debug("Queued conversational search event for visitor %s", session.get('visitor_id'))
 
-    except Exception as e:
-        print(f"Error writing conversational search event: {e}\n{traceback.format_exc()}")
+    except Exception:
+        app.logger.exception("Error queuing conversational search event")
 
 
 @app.route('/agent-search')
@@ -1081,20 +1542,12 @@ def agent_search():
     if not query:
         return redirect(url_for('homepage_agent'))
 
-    try:
-        page = int(request.args.get('page', 1))
-    except (ValueError, TypeError):
-        page = 1
-    if page < 1: page = 1
+    page = _get_page_number()
 
     try:
         # --- 1. Call Conversational Search API ---
-        branch_path = SearchServiceClient.branch_path(
-            project=config.PROJECT_ID, location=config.LOCATION,
-            catalog=config.CATALOG_ID, branch="default_branch"
-        )
         conv_search_request = ConversationalSearchRequest(
-            placement=conversational_placement, branch=branch_path, query=query,
+            placement=conversational_placement, branch=BRANCH_PATH, query=query,
             visitor_id=session.get('visitor_id'), conversation_id=conversation_id,
             conversational_filtering_spec=ConversationalSearchRequest.ConversationalFilteringSpec(
                 conversational_filtering_mode=ConversationalSearchRequest.ConversationalFilteringSpec.Mode.DISABLED
@@ -1102,9 +1555,10 @@ def agent_search():
         )
 
         # Log the request payload for debugging
-        print(f"DEBUG: Conversational Search Request (agent-search): {json.dumps(ConversationalSearchRequest.to_dict(conv_search_request), indent=2)}")
+        if app.logger.isEnabledFor(logging.DEBUG):
+            app.logger.debug("Conversational Search Request (agent-search): %s", orjson.dumps(ConversationalSearchRequest.to_dict(conv_search_request), option=orjson.OPT_INDENT_2).decode())
 
-        streaming_response = conversational_search_client.conversational_search(request=conv_search_request)
+        streaming_response = get_conversational_search_client().conversational_search(request=conv_search_request)
         response = ConversationalSearchResponse()
         for chunk in streaming_response:
             response._pb.MergeFrom(chunk._pb)
@@ -1122,7 +1576,8 @@ def agent_search():
         response.refined_search.extend(unique_refined_search) # Add unique items back
 
         # Log the full response payload for debugging
-        print(f"DEBUG: Conversational Search Response (agent-search): {json.dumps(ConversationalSearchResponse.to_dict(response), indent=2)}")
+        if app.logger.isEnabledFor(logging.DEBUG):
+            app.logger.debug("Conversational Search Response (agent-search): %s", orjson.dumps(ConversationalSearchResponse.to_dict(response), option=orjson.OPT_INDENT_2).decode())
 
         new_conversation_id = response.conversation_id
         user_query_types = set(response.user_query_types)
@@ -1130,7 +1585,7 @@ def agent_search():
         # Log the query types returned by the conversational search API.
         # This is useful for debugging and understanding user intent.
         for query_type in user_query_types:
-            print(f"INFO: Agent search handling '{query_type}' query type.")
+            app.logger.info("Agent search handling '%s' query type.", query_type)
 
         # --- 2. Handle Response ---
         # Determine the primary search query for the results grid.
@@ -1140,42 +1595,9 @@ def agent_search():
         page_size = 20
         offset = (page - 1) * page_size
 
-        # Facet and Filter handling (copied from /search endpoint)
-        facet_filters = []
-        selected_facets = {}
-        processed_keys = {'query', 'conversation_id', 'attribution_token', 'page'}
-
-        for key in request.args:
-            if key not in processed_keys:
-                values = request.args.getlist(key)
-                selected_facets[key] = values
-                if key in ['price', 'rating']:
-                    range_filters = []
-                    filter_key = 'price' if key == 'price' else key
-                    for v in values:
-                        try:
-                            min_val_str, max_val_str = v.split('-', 1)
-                            range_filter_parts = []
-                            if min_val_str: range_filter_parts.append(f'{filter_key} >= {float(min_val_str)}')
-                            if max_val_str: range_filter_parts.append(f'{filter_key} < {float(max_val_str)}')
-                            if range_filter_parts: range_filters.append(f"({' AND '.join(range_filter_parts)})")
-                        except (ValueError, IndexError): continue
-                    if range_filters: facet_filters.append(f"({' OR '.join(range_filters)})")
-                else:
-                    filter_values = ', '.join([f'"{v}"' for v in values])
-                    facet_filters.append(f'{key}: ANY({filter_values})')
-                processed_keys.add(key)
-        
-        search_filter = " AND ".join(facet_filters) if facet_filters else ""
-
-        # Facet Specs (copied from /search endpoint)
-        facet_specs = [
-            SearchRequest.FacetSpec(facet_key=SearchRequest.FacetSpec.FacetKey(key="brands", order_by="count desc"), limit=20, enable_dynamic_position=False),
-            SearchRequest.FacetSpec(facet_key=SearchRequest.FacetSpec.FacetKey(key="categories", order_by="count desc"), enable_dynamic_position=False),
-            SearchRequest.FacetSpec(facet_key=SearchRequest.FacetSpec.FacetKey(key="colorFamilies", order_by="count desc"), limit=10, enable_dynamic_position=True),
-            SearchRequest.FacetSpec(facet_key=SearchRequest.FacetSpec.FacetKey(key="price", intervals=[Interval(minimum=0.0, maximum=25.0), Interval(minimum=25.0, maximum=50.0), Interval(minimum=50.0, maximum=100.0), Interval(minimum=100.0, maximum=200.0), Interval(minimum=200.0)]), enable_dynamic_position=False),
-            SearchRequest.FacetSpec(facet_key=SearchRequest.FacetSpec.FacetKey(key="rating", intervals=[Interval(minimum=1.0, maximum=2.0), Interval(minimum=2.0, maximum=3.0), Interval(minimum=3.0, maximum=4.0), Interval(minimum=4.0)]), enable_dynamic_position=False),
-        ]
+        # Facet and Filter handling (shared with the /search endpoint)
+        facet_filters, selected_facets = _build_facet_filters(AGENT_SEARCH_RESERVED_ARGS)
+        search_filter = " AND ".join(facet_filters)
 
         # --- 3. Perform Main Search for Product Grid ---
         search_results = []
@@ -1189,42 +1611,35 @@ def agent_search():
         
         if not user_query_types.isdisjoint(product_seeking_types) and primary_search_query:
             try:
-                query_expansion_spec = SearchRequest.QueryExpansionSpec(
-                    condition=SearchRequest.QueryExpansionSpec.Condition.AUTO,
-                    pin_unexpanded_results=True
-                )
                 search_req = SearchRequest(
-                    placement=search_placement, branch=branch_path, query=primary_search_query,
+                    placement=search_placement, branch=BRANCH_PATH, query=primary_search_query,
                     visitor_id=session.get('visitor_id'), page_size=page_size, offset=offset,
-                    facet_specs=facet_specs, filter=search_filter, query_expansion_spec=query_expansion_spec,
+                    facet_specs=SEARCH_FACET_SPECS, filter=search_filter, query_expansion_spec=QUERY_EXPANSION_AUTO,
                 )
                 search_pager = search_client.search(request=search_req)
                 main_search_response = next(search_pager.pages, None)
                 if main_search_response:
                     search_results = main_search_response.results
-                    total_pages = int(math.ceil(main_search_response.total_size / page_size)) if main_search_response.total_size > 0 else 0
+                    total_pages = (main_search_response.total_size + page_size - 1) // page_size if main_search_response.total_size > 0 else 0
                     processed_facets = _process_facets(main_search_response.facets, selected_facets)
-                    results_for_js = [SearchResponse.SearchResult.to_dict(r) for r in search_results]
-            except Exception as e:
-                print(f"Error fetching main product grid for agent search: {e}")
+                    results_for_js = [{'id': r.id} for r in search_results]
+            except Exception:
+                app.logger.exception("Error fetching main product grid for agent search")
         
         # --- 4. Handle non-LLM/Support queries (generate custom text and links) ---
         generated_answer = ""
         page_links = []
         support_links = _get_support_links()
-        support_query_types = {'ORDER_SUPPORT', 'DEALS_AND_COUPONS', 'STORE_RELEVANT', 'RETAIL_SUPPORT'}
-
-        if 'RETAIL_IRRELEVANT' in user_query_types:
-            response.conversational_text_response = "I am a shopping assistant. How can I help you find what you're looking for today?"
-        elif 'BLOCKLISTED' in user_query_types:
-            response.conversational_text_response = "I'm sorry, I cannot fulfill this request."
-        elif 'QUERY_TYPE_UNSPECIFIED' in user_query_types:
-            response.conversational_text_response = "I'm not sure I understand. Could you please rephrase your question?"
-        elif not user_query_types.isdisjoint(support_query_types):
-            matched_type = next(iter(user_query_types.intersection(support_query_types)))
-            print(f"INFO: Handling '{matched_type}' query type with generated answer flow in agent search.")
+
+        canned_type = next((t for t in CANNED_QUERY_TYPE_RESPONSES if t in user_query_types), None)
+        if canned_type:
+            response.conversational_text_response = CANNED_QUERY_TYPE_RESPONSES[canned_type]
+        elif not user_query_types.isdisjoint(SUPPORT_QUERY_TYPES):
+            matched_type = next(iter(user_query_types.intersection(SUPPORT_QUERY_TYPES)))
+            app.logger.info("Handling '%s' query type with generated answer flow in agent search.", matched_type)
             try:
-                if config.ENABLE_SUPPORT_AGENT and support_answer_client:
+                support_answer_client = get_support_answer_client()
+                if support_answer_client:
                     # Use the streamlined `answer_query` method for generated answers.
                     answer_generation_spec = discoveryengine.AnswerQueryRequest.AnswerGenerationSpec(
                         model_spec=discoveryengine.AnswerQueryRequest.AnswerGenerationSpec.ModelSpec(model_version="stable"),
@@ -1245,30 +1660,20 @@ def agent_search():
                         user_pseudo_id=session.get('visitor_id'),
                         search_spec=search_spec
                     )
-                    print(f"DEBUG: Support answer_query request payload (agent-search): {json.dumps(discoveryengine.AnswerQueryRequest.to_dict(answer_query_req), indent=2)}")
+                    if app.logger.isEnabledFor(logging.DEBUG):
+                        app.logger.debug("Support answer_query request payload (agent-search): %s", orjson.dumps(discoveryengine.AnswerQueryRequest.to_dict(answer_query_req), option=orjson.OPT_INDENT_2).decode())
                     answer_query_resp = support_answer_client.answer_query(request=answer_query_req)
 
                     if answer_query_resp.answer and answer_query_resp.answer.state.name == 'SUCCEEDED':
-                        print(f"DEBUG: Support answer_query response JSON (agent-search): {json.dumps(discoveryengine.Answer.to_dict(answer_query_resp.answer), indent=2)}")
+                        if app.logger.isEnabledFor(logging.DEBUG):
+                            app.logger.debug("Support answer_query response JSON (agent-search): %s", orjson.dumps(discoveryengine.Answer.to_dict(answer_query_resp.answer), option=orjson.OPT_INDENT_2).decode())
                         generated_answer = markdown_parser.render(answer_query_resp.answer.answer_text)
 
-            except Exception as e:
-                print(f"Error calling support search/answer API in agent search: {e}")
+            except Exception:
+                app.logger.exception("Error calling support search/answer API in agent search")
 
-            default_texts = {
-                'ORDER_SUPPORT': "It looks like you have a question about an order. You can track your order or view your order history on our Orders page.",
-                'DEALS_AND_COUPONS': "Looking for a good deal? All of our current promotions, discounts, and coupons are available on our deals page.",
-                'STORE_RELEVANT': "For questions about store locations, hours, or to check product availability, our store finder can help.",
-                'RETAIL_SUPPORT': "For questions about purchases, payment methods, returns, or shipping, our support page has the answers."
-            }
-            page_link_info = {
-                'ORDER_SUPPORT': {'text': "Go to My Orders", 'url': support_links.get('ORDER_SUPPORT')},
-                'DEALS_AND_COUPONS': {'text': "View Promotions", 'url': support_links.get('DEALS_AND_COUPONS')},
-                'STORE_RELEVANT': {'text': "Find a Store", 'url': support_links.get('STORE_RELEVANT')},
-                'RETAIL_SUPPORT': {'text': "Visit Support", 'url': support_links.get('RETAIL_SUPPORT')}
-            }
-            response.conversational_text_response = default_texts[matched_type]
-            page_links.append(page_link_info[matched_type])
+            response.conversational_text_response = SUPPORT_DEFAULT_TEXTS[matched_type]
+            page_links.append({'text': SUPPORT_LINK_TEXTS[matched_type], 'url': support_links.get(matched_type)})
         elif not response.conversational_text_response and 'SIMPLE_PRODUCT_SEARCH' not in user_query_types:
             response.conversational_text_response = "Here's what I found."
 
@@ -1298,9 +1703,22 @@ def agent_search():
         )
 
     except (GoogleAPICallError, Exception) as e:
-        print(f"Error during agent search: {e}\n{traceback.format_exc()}")
+        app.logger.exception("Error during agent search")
         return render_template('agent_search_results.html', error=str(e), query=query)
 
+# The chat pages keep the conversation in the session so it can be re-rendered
+# on reload. Only the most recent messages are kept, so the session (and the
+# cost of serializing it on every response) stops growing with the conversation.
+CHAT_HISTORY_MAX_MESSAGES = 40  # 20 user/bot turns
+
+
+def _append_chat_history(history_key, *messages):
+    """Appends messages to a session chat history, keeping only the most recent."""
+    history = session.get(history_key, [])
+    history.extend(messages)
+    session[history_key] = history[-CHAT_HISTORY_MAX_MESSAGES:]
+
+
 @app.route('/chat', methods=['GET'])
 def chat():
     """Renders the conversational commerce chat interface."""
@@ -1334,18 +1752,22 @@ def api_chat():
     if 'chat_history' not in session:
         session['chat_history'] = []
 
+    # A query without a single letter or digit (e.g. "??" or "...") can only
+    # come back as QUERY_TYPE_UNSPECIFIED, so answer it without the API call.
+    if not any(ch.isalnum() for ch in query):
+        bot_response = {
+            'is_user': False, 'text': CANNED_QUERY_TYPE_RESPONSES['QUERY_TYPE_UNSPECIFIED'],
+            'followup_question': None, 'refined_queries': [], 'products': [],
+            'user_query_types': ['QUERY_TYPE_UNSPECIFIED'],
+        }
+        _append_chat_history('chat_history', {'is_user': True, 'text': query}, bot_response)
+        return jsonify({'bot_response': bot_response, 'conversation_id': conversation_id})
+
     try:
         # Build the conversational search request
-        branch_path = SearchServiceClient.branch_path(
-            project=config.PROJECT_ID,
-            location=config.LOCATION,
-            catalog=config.CATALOG_ID,
-            branch="default_branch"
-        )
-
         conv_search_request = ConversationalSearchRequest(
             placement=conversational_placement,
-            branch=branch_path,
+            branch=BRANCH_PATH,
             query=query,
             visitor_id=session.get('visitor_id'),
             conversation_id=conversation_id,
@@ -1355,9 +1777,10 @@ def api_chat():
         )
 
         # Log the request payload for debugging
-        print(f"DEBUG: Conversational Search Request (api/chat): {json.dumps(ConversationalSearchRequest.to_dict(conv_search_request), indent=2)}")
+        if app.logger.isEnabledFor(logging.DEBUG):
+            app.logger.debug("Conversational Search Request (api/chat): %s", orjson.dumps(ConversationalSearchRequest.to_dict(conv_search_request), option=orjson.OPT_INDENT_2).decode())
 
-        streaming_response = conversational_search_client.conversational_search(request=conv_search_request)
+        streaming_response = get_conversational_search_client().conversational_search(request=conv_search_request)
 
         # Aggregate the streaming response
         response = ConversationalSearchResponse()
@@ -1365,7 +1788,8 @@ def api_chat():
             response._pb.MergeFrom(chunk._pb)
 
         # Log the full response payload for debugging
-        print(f"DEBUG: Conversational Search Response (api/chat): {json.dumps(ConversationalSearchResponse.to_dict(response), indent=2)}")
+        if app.logger.isEnabledFor(logging.DEBUG):
+            app.logger.debug("Conversational Search Response (api/chat): %s", orjson.dumps(ConversationalSearchResponse.to_dict(response), option=orjson.OPT_INDENT_2).decode())
 
         new_conversation_id = response.conversation_id
         user_query_types = set(response.user_query_types)
@@ -1390,49 +1814,23 @@ def api_chat():
         support_links = _get_support_links()
 
         # Category 1: Irrelevant queries that don't require an LLM answer
-        if 'RETAIL_IRRELEVANT' in user_query_types:
-            print("INFO: Handling 'RETAIL_IRRELEVANT' query type.")
-            bot_response = {
-                'text': "I am a shopping assistant. How can I help you find what you're looking for today?"
-            }
-            custom_response_generated = True
-        elif 'BLOCKLISTED' in user_query_types:
-            print("INFO: Handling 'BLOCKLISTED' query type.")
-            bot_response = {
-                'text': "I'm sorry, I cannot fulfill this request."
-            }
-            custom_response_generated = True
-        elif 'QUERY_TYPE_UNSPECIFIED' in user_query_types:
-            print("INFO: Handling 'QUERY_TYPE_UNSPECIFIED' query type.")
-            bot_response = {
-                'text': "I'm not sure I understand. Could you please rephrase your question? I can help you find products and answer questions about them."
-            }
+        canned_type = next((t for t in CANNED_QUERY_TYPE_RESPONSES if t in user_query_types), None)
+        if canned_type:
+            app.logger.info("Handling '%s' query type.", canned_type)
+            bot_response = {'text': CANNED_QUERY_TYPE_RESPONSES[canned_type]}
             custom_response_generated = True
 
         # Category 2: Support and information queries with Generated Answers
-        support_query_types = {'ORDER_SUPPORT', 'DEALS_AND_COUPONS', 'STORE_RELEVANT', 'RETAIL_SUPPORT'}
-        if config.ENABLE_SUPPORT_AGENT and not user_query_types.isdisjoint(support_query_types):
+        if config.ENABLE_SUPPORT_AGENT and not user_query_types.isdisjoint(SUPPORT_QUERY_TYPES):
             # Get the specific support type that was matched
-            matched_type = next(iter(user_query_types.intersection(support_query_types)))
-            print(f"INFO: Handling '{matched_type}' query type with generated answer flow.")
+            matched_type = next(iter(user_query_types.intersection(SUPPORT_QUERY_TYPES)))
+            app.logger.info("Handling '%s' query type with generated answer flow.", matched_type)
 
             generated_answer = ""
-            page_link_info = {
-                'ORDER_SUPPORT': {'text': "Go to My Orders", 'url': support_links.get('ORDER_SUPPORT')},
-                'DEALS_AND_COUPONS': {'text': "View Promotions", 'url': support_links.get('DEALS_AND_COUPONS')},
-                'STORE_RELEVANT': {'text': "Find a Store", 'url': support_links.get('STORE_RELEVANT')},
-                'RETAIL_SUPPORT': {'text': "Visit Support", 'url': support_links.get('RETAIL_SUPPORT')}
-            }
-
-            default_texts = {
-                'ORDER_SUPPORT': "It looks like you have a question about an order. You can track your order or view your order history on our Orders page.",
-                'DEALS_AND_COUPONS': "Looking for a good deal? All of our current promotions, discounts, and coupons are available on our deals page.",
-                'STORE_RELEVANT': "For questions about store locations, hours, or to check product availability, our store finder can help.",
-                'RETAIL_SUPPORT': "For questions about purchases, payment methods, returns, or shipping, our support page has the answers."
-            }
 
             try:
                 # Use the new support engine config for generated answers
+                support_answer_client = get_support_answer_client()
                 if support_answer_client:
                     # Use the streamlined `answer_query` method for generated answers.
                     answer_generation_spec = discoveryengine.AnswerQueryRequest.AnswerGenerationSpec(
@@ -1454,20 +1852,22 @@ def api_chat():
                         user_pseudo_id=session.get('visitor_id'),
                         search_spec=search_spec
                     )
-                    print(f"DEBUG: Support answer_query request payload (api/chat): {json.dumps(discoveryengine.AnswerQueryRequest.to_dict(answer_query_req), indent=2)}")
+                    if app.logger.isEnabledFor(logging.DEBUG):
+                        app.logger.debug("Support answer_query request payload (api/chat): %s", orjson.dumps(discoveryengine.AnswerQueryRequest.to_dict(answer_query_req), option=orjson.OPT_INDENT_2).decode())
                     answer_query_resp = support_answer_client.answer_query(request=answer_query_req)
 
                     if answer_query_resp.answer and answer_query_resp.answer.state.name == 'SUCCEEDED':
-                        print(f"DEBUG: Support answer_query response JSON (api/chat): {json.dumps(discoveryengine.Answer.to_dict(answer_query_resp.answer), indent=2)}")
+                        if app.logger.isEnabledFor(logging.DEBUG):
+                            app.logger.debug("Support answer_query response JSON (api/chat): %s", orjson.dumps(discoveryengine.Answer.to_dict(answer_query_resp.answer), option=orjson.OPT_INDENT_2).decode())
                         generated_answer = markdown_parser.render(answer_query_resp.answer.answer_text)
 
-            except Exception as e:
-                print(f"Error calling support search/answer API: {e}")
+            except Exception:
+                app.logger.exception("Error calling support search/answer API")
 
             bot_response = {
-                'text': default_texts[matched_type],
+                'text': SUPPORT_DEFAULT_TEXTS[matched_type],
                 'generated_answer': generated_answer,
-                'page_links': [page_link_info[matched_type]]
+                'page_links': [{'text': SUPPORT_LINK_TEXTS[matched_type], 'url': support_links.get(matched_type)}]
             }
             custom_response_generated = True
 
@@ -1484,7 +1884,7 @@ def api_chat():
 
             # Log the query types being handled in this standard flow.
             for query_type in user_query_types:
-                print(f"INFO: Handling '{query_type}' query type.")
+                app.logger.info("Handling '%s' query type.", query_type)
 
             # For SIMPLE_PRODUCT_SEARCH, there's no LLM text. Provide a default for better UX.
             conversational_text = response.conversational_text_response
@@ -1502,30 +1902,17 @@ def api_chat():
 
             if response.refined_search:
                 refined_query = response.refined_search[0].query
-                facet_specs = [
-                    SearchRequest.FacetSpec(facet_key=SearchRequest.FacetSpec.FacetKey(key="brands")),
-                    SearchRequest.FacetSpec(facet_key=SearchRequest.FacetSpec.FacetKey(key="categories")),
-                    SearchRequest.FacetSpec(facet_key=SearchRequest.FacetSpec.FacetKey(key="price")),
-                    SearchRequest.FacetSpec(facet_key=SearchRequest.FacetSpec.FacetKey(key="rating")),
-                ]
-                query_expansion_spec = SearchRequest.QueryExpansionSpec(condition=SearchRequest.QueryExpansionSpec.Condition.AUTO, pin_unexpanded_results=True)
                 search_req = SearchRequest(
-                    placement=search_placement, branch=branch_path, query=refined_query,
+                    placement=search_placement, branch=BRANCH_PATH, query=refined_query,
                     visitor_id=session.get('visitor_id'), page_size=3,
-                    query_expansion_spec=query_expansion_spec, facet_specs=facet_specs,
+                    query_expansion_spec=QUERY_EXPANSION_AUTO, facet_specs=CHAT_FACET_SPECS,
                 )
                 search_pager = search_client.search(request=search_req)
                 search_response_for_event = next(search_pager.pages, None)
 
                 if search_response_for_event:
                     for r in search_response_for_event.results:
-                        product_dict = SearchResponse.SearchResult.to_dict(r)
-                        # The product data is nested inside the 'product' key of the search result.
-                        simplified_product = {
-                            'id': product_dict.get('id'),
-                            'product': product_dict.get('product', {})
-                        }
-                        products_for_session.append(simplified_product)
+                        products_for_session.append(_search_result_to_dict(r))
             
             bot_response['products'] = products_for_session
             
@@ -1534,48 +1921,30 @@ def api_chat():
         # to include the attributionToken from the secondary search response to link
         # this event to the model's output and the products that were shown.
         try:
-            parent = user_event_client.catalog_path(
-                project=config.PROJECT_ID,
-                location=config.LOCATION,
-                catalog=config.CATALOG_ID
-            )
-
-            # Extract product IDs from the results for the event payload
-            product_ids = [p['id'] for p in products_for_session]
-            product_details_list = [{"product": {"id": pid}} for pid in product_ids]
-
-            user_info = {
-                "userAgent": request.user_agent.string,
-                "ipAddress": request.remote_addr
-            }
-            if session.get('user'):
-                user_info["userId"] = session['user']['sub']
-
             # The attribution token comes from the secondary search response, not the conversational one.
             event_attribution_token = search_response_for_event.attribution_token if search_response_for_event else None
 
-            event_payload = {
-                "eventType": "search",
-                "visitorId": session.get('visitor_id'),
-                "userInfo": user_info,
-                "searchQuery": query,
-                "attributionToken": event_attribution_token,
-                "productDetails": product_details_list,
+            user_event = UserEvent(
+                event_type="search",
+                visitor_id=session.get('visitor_id'),
+                user_info=_request_user_info(),
+                search_query=query,
+                attribution_token=event_attribution_token,
+                # Use the IDs of the products shown with the response
+                product_details=[ProductDetail(product=Product(id=p['id'])) for p in products_for_session],
                 # The UserEvent object uses 'sessionId' to group related events.
                 # We can use the 'conversation_id' from the chat response for this purpose.
-                "sessionId": new_conversation_id,
-                "uri": url_for('chat', _external=True),
-                "referrerUri": request.referrer,
-            }
-
-            user_event = UserEvent.from_json(json.dumps(event_payload))
-            write_request = WriteUserEventRequest(parent=parent, user_event=user_event)
-            user_event_client.write_user_event(request=write_request)
-            print(f"Successfully wrote conversational search event for visitor {session.get('visitor_id')}")
+                session_id=new_conversation_id,
+                uri=url_for('chat', _external=True),
+                referrer_uri=request.referrer,
+            )
+            # Queue the event; it is written to the Retail API in the background.
+            _enqueue_user_event(user_event)
+            app.logger.debug("Queued conversational search event for visitor %s", session.get('visitor_id'))
 
-        except Exception as e:
+        except Exception:
             # Log the error but don't block the user's chat experience
-            print(f"Error writing conversational search event: {e}\n{traceback.format_exc()}")
+            app.logger.exception("Error queuing conversational search event")
 
         # Create a lightweight version of the bot response for session storage
         # to avoid exceeding cookie size limits. The full product data is sent
@@ -1585,11 +1954,7 @@ def api_chat():
         session_bot_response['products'] = []  # Remove heavy product data for session
 
         # Add the user's message and the lightweight bot response to session history
-        session['chat_history'].extend([
-            {'is_user': True, 'text': query},
-            session_bot_response
-        ])
-        session.modified = True
+        _append_chat_history('chat_history', {'is_user': True, 'text': query}, session_bot_response)
         
         # Persist the conversation ID in the server-side session to maintain
         # context across page reloads, ensuring consistency with chat history.
@@ -1604,12 +1969,8 @@ def api_chat():
     except (GoogleAPICallError, Exception) as e:
         error_message = "Sorry, I encountered an error. Please try again."
         # Add the user's message and the error response to session history
-        session['chat_history'].extend([
-            {'is_user': True, 'text': query},
-            {'is_user': False, 'text': error_message}
-        ])
-        session.modified = True
-        print(f"Error during conversational search: {e}\n{traceback.format_exc()}")
+        _append_chat_history('chat_history', {'is_user': True, 'text': query}, {'is_user': False, 'text': error_message})
+        app.logger.exception("Error during conversational search")
         # Return error to client
         return jsonify({"error": str(e), "bot_response": {'text': error_message}}), 500
 
@@ -1622,37 +1983,51 @@ def clear_chat():
     return redirect(url_for('chat'))
 
 
-@app.route('/api/autocomplete')
-def autocomplete():
-    """Provides search suggestions based on the user's partial query."""
-    query = request.args.get('query', '').strip()
-    if not query:
-        return jsonify([])
+AUTOCOMPLETE_CACHE_TTL_SECONDS = 60
 
-    # The SearchServiceClient does not have a 'catalog_path' helper.
-    # We can use the product_client or user_event_client to build the path.
-    catalog_path = user_event_client.catalog_path(
-        project=config.PROJECT_ID,
-        location=config.LOCATION,
-        catalog=config.CATALOG_ID
-    )
 
+# Suggestions are requested on every keystroke, and the same prefixes come up
+# again and again across visitors, so they are cached briefly per query. The
+# visitor ID of whichever request misses is still sent with the call. The
+# condition makes concurrent misses for the same prefix wait for the one call
+# already in flight instead of each sending their own.
+_autocomplete_condition = threading.Condition()
+
+
+@cached(
+    TTLCache(maxsize=4096, ttl=AUTOCOMPLETE_CACHE_TTL_SECONDS),
+    key=lambda query, visitor_id: query,
+    lock=_autocomplete_condition,
+    condition=_autocomplete_condition,
+)
+def _complete_query(query, visitor_id):
+    """Returns the autocomplete suggestions for a (lowercased) partial query."""
     complete_query_request = CompleteQueryRequest(
-        catalog=catalog_path,
+        catalog=CATALOG_PATH,
         query=query,
-        visitor_id=session.get('visitor_id'),
+        visitor_id=visitor_id,
         # By default, the API will use a dataset generated from user events.
     )
+    response = completion_client.complete_query(request=complete_query_request)
+    # Extract just the suggestion text from the response. A tuple keeps the
+    # shared cached value from being modified by a caller.
+    return tuple(result.suggestion for result in response.completion_results)
+
+
+@app.route('/api/autocomplete')
+def autocomplete():
+    """Provides search suggestions based on the user's partial query."""
+    query = request.args.get('query', '').strip()
+    if not query:
+        return jsonify([])
 
     try:
-        response = completion_client.complete_query(request=complete_query_request)
-        # Extract just the suggestion text from the response
-        suggestions = [result.suggestion for result in response.completion_results]
-        # Add a log to see what the API is returning in the backend console
-        print(f"Autocomplete suggestions for '{query}': {suggestions}")
+        suggestions = _complete_query(query.lower(), session.get('visitor_id'))
+        # Log what the API is returning; this runs on every keystroke, so only at DEBUG
+        app.logger.debug("Autocomplete suggestions for '%s': %s", query, suggestions)
         return jsonify(suggestions)
-    except Exception as e:
-        print(f"Error during autocomplete: {e}")
+    except Exception:
+        app.logger.exception("Error during autocomplete")
         return jsonify([]) # Return empty list on error to prevent frontend issues
 
 
@@ -1685,53 +2060,37 @@ def track_event():
     # pageCategories, we fetch them here to ensure the event is valid.
     # This makes the system more robust against client-side issues.
     if event_data.get("eventType") == "category-page-view" and "pageCategories" not in event_data:
-        print("Enriching category-page-view event with pageCategories on the server.")
+        app.logger.debug("Enriching category-page-view event with pageCategories on the server.")
         try:
-            # This logic is the same as in the `categories_list` route.
-            facet_spec = SearchRequest.FacetSpec(
-                facet_key=SearchRequest.FacetSpec.FacetKey(key="categories"),
-                limit=250  # Match the limit used on the categories page itself.
-            )
-            branch_path = SearchServiceClient.branch_path(
-                project=config.PROJECT_ID, location=config.LOCATION,
-                catalog=config.CATALOG_ID, branch="default_branch"
-            )
-            search_request = SearchRequest(
-                placement=search_placement, branch=branch_path, query="",
-                visitor_id=event_data.get('visitorId'), page_size=0, facet_specs=[facet_spec]
-            )
-            search_response = next(search_client.search(search_request).pages)
-            if search_response.facets:
-                event_data["pageCategories"] = [v.value for v in search_response.facets[0].values]
+            # Reuse the cached facet that the `categories_list` route renders,
+            # rather than searching the catalog again for every event.
+            category_facet = _get_category_facet()
+            if category_facet:
+                event_data["pageCategories"] = [v.value for v in category_facet.values]
         except Exception as e:
-            print(f"Could not enrich category-page-view event: {e}")
+            app.logger.warning("Could not enrich category-page-view event: %s", e)
 
-    print(f"Received and enriched event data: {json.dumps(event_data, indent=2)}")
+    if app.logger.isEnabledFor(logging.DEBUG):
+        app.logger.debug("Received and enriched event data: %s", orjson.dumps(event_data, option=orjson.OPT_INDENT_2).decode())
 
     try:
-        # The parent catalog resource name
-        parent = user_event_client.catalog_path(
-            project=config.PROJECT_ID,
-            location=config.LOCATION,
-            catalog=config.CATALOG_ID
-        )
-
         # Handle both a single event object and an array of events (from sendBeacon)
         events_to_process = event_data if isinstance(event_data, list) else [event_data]
 
         for event in events_to_process:
-            # Construct the UserEvent object from the client-side payload
-            user_event = UserEvent.from_json(json.dumps(event))
-
-            # Write the event
-            write_request = WriteUserEventRequest(parent=parent, user_event=user_event)
-            user_event_client.write_user_event(request=write_request)
+            # Construct the UserEvent object from the client-side payload. The
+            # dict is parsed directly rather than re-encoded as a JSON string
+            # for `UserEvent.from_json`; unknown fields are still rejected.
+            user_event = UserEvent()
+            json_format.ParseDict(event, UserEvent.pb(user_event))
 
-            print(f"Successfully wrote event: {user_event.event_type} for visitor {user_event.visitor_id}")
+            # Queue the event; it is written to the Retail API in the background.
+            _enqueue_user_event(user_event)
+            app.logger.debug("Queued event: %s for visitor %s", user_event.event_type, user_event.visitor_id)
 
         return {"status": "success"}, 200
-    except Exception as e:
-        print(f"Error writing user event: {e}\n{traceback.format_exc()}")
+    except Exception:
+        app.logger.exception("Error writing user event")
         return {"error": "Failed to write event"}, 500
 
 
@@ -1744,11 +2103,11 @@ def add_to_cart():
     product_image = request.form.get('product_image')
     attribution_token = request.form.get('attribution_token')
 
-    try:
-        # More robustly handle conversion from form string to float.
+    # Default to 0.0 if price is missing or not a valid number. The string is
+    # checked up front so malformed input never raises inside float().
+    if price_str and price_str.replace('.', '', 1).isdecimal():
         product_price = float(price_str)
-    except (ValueError, TypeError):
-        # Default to 0.0 if price is missing, not a valid number, or None.
+    else:
         product_price = 0.0
 
     if not product_id:
@@ -1756,43 +2115,22 @@ def add_to_cart():
 
     # --- Track add-to-cart event on Server-Side for Reliability ---
     try:
-        parent = user_event_client.catalog_path(
-            project=config.PROJECT_ID,
-            location=config.LOCATION,
-            catalog=config.CATALOG_ID
+        visitor_id = session.get('visitor_id')
+        user_event = UserEvent(
+            event_type="add-to-cart",
+            visitor_id=visitor_id,
+            cart_id=visitor_id, # Use visitorId as a stable cartId
+            product_details=[ProductDetail(product=Product(id=product_id), quantity=1)],
+            uri=request.referrer or url_for('index', _external=True), # Page where add was clicked
+            attribution_token=attribution_token,
+            # Add userInfo for a high-quality server-side event
+            user_info=_request_user_info(),
         )
-
-        product_details = [{
-            "product": {"id": product_id},
-            "quantity": 1
-        }]
-
-        event_payload = {
-            "eventType": "add-to-cart",
-            "visitorId": session.get('visitor_id'),
-            "cartId": session.get('visitor_id'), # Use visitorId as a stable cartId
-            "productDetails": product_details,
-            "uri": request.referrer or url_for('index', _external=True), # Page where add was clicked
-        }
-        if attribution_token:
-            event_payload["attributionToken"] = attribution_token
-
-        # Add userInfo for a high-quality server-side event
-        user_info = {
-            "userAgent": request.user_agent.string,
-            "ipAddress": request.remote_addr
-        }
-        if session.get('user'):
-            user_info["userId"] = session['user']['sub']
-        event_payload['userInfo'] = user_info
-
-        user_event = UserEvent.from_json(json.dumps(event_payload))
-        write_request = WriteUserEventRequest(parent=parent, user_event=user_event)
-        user_event_client.write_user_event(request=write_request)
-        print(f"Successfully wrote server-side event: add-to-cart for visitor {session.get('visitor_id')}")
-    except Exception as e:
+        _enqueue_user_event(user_event)
+        app.logger.debug("Queued server-side event: add-to-cart for visitor %s", session.get('visitor_id'))
+    except Exception:
         # Log the error but don't block the user from completing the purchase
-        print(f"Error writing server-side add-to-cart event: {e}\n{traceback.format_exc()}")
+        app.logger.exception("Error writing server-side add-to-cart event")
 
     # Add item to cart
     cart = session.get('cart', {})
@@ -1808,8 +2146,9 @@ def add_to_cart():
         }
     session['cart'] = cart
 
-    # Update total
-    session['cart_total'] = sum(item['price'] * item['quantity'] for item in cart.values())
+    # Update the total by the price of the one unit added (an existing line
+    # keeps the price it was first added at), rather than re-summing the cart.
+    session['cart_total'] = session.get('cart_total', 0.0) + cart[product_id]['price']
 
     # Flash a success message to be displayed on the next page
     cart_url = url_for('view_cart')
@@ -1819,6 +2158,89 @@ def add_to_cart():
     return redirect(request.referrer or url_for('index'))
 
 
+# A product is served from the caches for at most PRODUCT_CACHE_TTL_SECONDS
+# after it was fetched. With Redis, that time is split between the two tiers:
+# a product read from Redis can be near the end of its Redis TTL, and is then
+# kept in-process for PRODUCT_LOCAL_CACHE_TTL_SECONDS on top of it.
+PRODUCT_CACHE_TTL_SECONDS = 300
+PRODUCT_LOCAL_CACHE_TTL_SECONDS = 60 if redis_client else PRODUCT_CACHE_TTL_SECONDS
+PRODUCT_REDIS_CACHE_TTL_SECONDS = PRODUCT_CACHE_TTL_SECONDS - PRODUCT_LOCAL_CACHE_TTL_SECONDS
+
+
+# Product data changes at catalog-update timescales, while the same products
+# are looked up again and again by the product, cart and checkout pages. Each
+# product is cached for a few minutes; failed lookups are not cached. Hit and
+# miss counts for both tiers are logged at DEBUG level, to help tune the TTLs.
+@cached(
+    TTLCache(maxsize=4096, ttl=PRODUCT_LOCAL_CACHE_TTL_SECONDS),
+    lock=threading.Lock(),
+    info=True,
+)
+def _get_product(product_id):
+    """
+    Returns the Product for `product_id` from the catalog's default branch.
+    With Redis, products are also shared between server processes, so a
+    product fetched by one worker doesn't have to be fetched again by the rest.
+    """
+    if not redis_client:
+        if app.logger.isEnabledFor(logging.DEBUG):
+            app.logger.debug("Product cache miss for %s (%s)", product_id, _get_product.cache_info())
+        return product_client.get_product(name=_product_name(product_id))
+
+    cache_key = f"product:{product_id}"
+    product_bytes = redis_client.get(cache_key)
+    if product_bytes is not None:
+        _product_redis_stats['hits'] += 1
+        _log_product_cache_miss(product_id, 'hit')
+        return Product.deserialize(product_bytes)
+    _product_redis_stats['misses'] += 1
+    _log_product_cache_miss(product_id, 'miss')
+    product = product_client.get_product(name=_product_name(product_id))
+    redis_client.setex(cache_key, PRODUCT_REDIS_CACHE_TTL_SECONDS, Product.serialize(product))
+    return product
+
+
+# Approximate per-process counts of Redis product cache lookups; they are only
+# used for logging, so updates from concurrent threads aren't synchronized.
+_product_redis_stats = collections.Counter()
+
+
+def _log_product_cache_miss(product_id, redis_result):
+    """Logs an in-process product cache miss and the result of the Redis lookup behind it."""
+    if app.logger.isEnabledFor(logging.DEBUG):
+        app.logger.debug(
+            "Product cache miss for %s, Redis %s (%s; Redis hits=%d, misses=%d)",
+            product_id, redis_result, _get_product.cache_info(),
+            _product_redis_stats['hits'], _product_redis_stats['misses'],
+        )
+
+
+# Cart pages look up every product in the cart. The GetProduct calls are
+# independent and spend their time waiting on the network, so they are issued
+# concurrently from a shared pool instead of one after another.
+product_fetch_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix='product-fetch')
+
+
+def _fetch_product(product_id):
+    """Returns the Product for `product_id`, or None if it couldn't be fetched."""
+    try:
+        return _get_product(product_id)
+    except Exception as e:
+        app.logger.warning("Error fetching product %s: %s", product_id, e)
+        return None
+
+
+def _fetch_products(product_ids):
+    """
+    Fetches the given products concurrently and returns a dict of product ID to
+    Product, with None for any product that couldn't be fetched.
+    """
+    product_ids = list(product_ids)
+    if len(product_ids) == 1:
+        return {product_ids[0]: _fetch_product(product_ids[0])}
+    return dict(zip(product_ids, product_fetch_executor.map(_fetch_product, product_ids)))
+
+
 @app.route('/cart')
 def view_cart():
     """Displays the shopping cart."""
@@ -1828,20 +2250,13 @@ def view_cart():
     if not cart_from_session:
         return render_template('cart.html', cart={}, total=total, event_type='shopping-cart-page-view')
 
+    products = _fetch_products(cart_from_session)
+
     rich_cart_items = {}
     for product_id, item_data in cart_from_session.items():
-        try:
-            product_name = product_client.product_path(
-                project=config.PROJECT_ID,
-                location=config.LOCATION,
-                catalog=config.CATALOG_ID,
-                branch="default_branch",
-                product=product_id
-            )
-            product = product_client.get_product(name=product_name)
-            
-            quantity = item_data if isinstance(item_data, int) else item_data.get('quantity', 1)
-
+        product = products[product_id]
+        quantity = item_data if isinstance(item_data, int) else item_data.get('quantity', 1)
+        if product is not None:
             rich_cart_items[product_id] = {
                 'id': product.id,
                 'title': product.title,
@@ -1849,10 +2264,8 @@ def view_cart():
                 'price': product.price_info.price if product.price_info else 0.0,
                 'quantity': quantity
             }
-        except Exception as e:
-            print(f"Error fetching product {product_id} for cart view: {e}")
+        else:
             # If a product can't be fetched, we'll still show it with basic info.
-            quantity = item_data if isinstance(item_data, int) else item_data.get('quantity', 1)
             price = 0.0 if isinstance(item_data, int) else item_data.get('price', 0.0)
             rich_cart_items[product_id] = {
                 'id': product_id, 'title': 'Product not available', 'image': '',
@@ -1870,10 +2283,14 @@ def remove_from_cart(product_id):
     """Removes an item from the cart."""
     cart = session.get('cart', {})
     # Safely remove the item if it exists
-    cart.pop(product_id, None)
+    removed = cart.pop(product_id, None)
     session['cart'] = cart
-    # Recalculate total
-    session['cart_total'] = sum(item['price'] * item['quantity'] for item in cart.values())
+    # Subtract the removed line from the total, resetting it once the cart is
+    # empty so floating point error can't accumulate.
+    if not cart:
+        session['cart_total'] = 0.0
+    elif removed:
+        session['cart_total'] = max(0.0, session.get('cart_total', 0.0) - removed['price'] * removed['quantity'])
     return redirect(url_for('view_cart'))
 
 
@@ -1882,110 +2299,125 @@ def checkout():
     """Simulates checkout, tracks the purchase event, and redirects to a confirmation page."""
     cart_from_session = session.get('cart', {})
     total_at_checkout = session.get('cart_total', 0.0)
-    transaction_id = str(uuid.uuid4())
+    transaction_id = uuid.uuid4().hex
     visitor_id = session.get('visitor_id')
 
-    # We need to enrich the cart items with titles for the confirmation page.
+    # A single pass over the cart builds both the items shown on the
+    # confirmation page (enriched with titles) and the product details for the
+    # purchase event (using the cart's prices).
+    products = _fetch_products(cart_from_session)
     cart_at_checkout = []
-    if cart_from_session:
-        for product_id, item_data in cart_from_session.items():
-            try:
-                product_name = product_client.product_path(
-                    project=config.PROJECT_ID, location=config.LOCATION,
-                    catalog=config.CATALOG_ID, branch="default_branch", product=product_id
-                )
-                product = product_client.get_product(name=product_name)
-                cart_at_checkout.append({
-                    'id': product_id,
-                    'title': product.title,
-                    'quantity': item_data['quantity']
-                })
-            except Exception as e:
-                print(f"Error fetching product {product_id} for checkout: {e}")
-                cart_at_checkout.append({
-                    'id': product_id, 'title': 'Unknown Product', 'quantity': item_data['quantity']
-                })
+    product_details = []
+    for product_id, item_data in cart_from_session.items():
+        quantity = item_data['quantity']
+        product = products[product_id]
+        title = product.title if product is not None else 'Unknown Product'
+        cart_at_checkout.append({'id': product_id, 'title': title, 'quantity': quantity})
+        product_details.append(ProductDetail(
+            product=Product(
+                id=product_id,
+                # Include priceInfo for revenue optimization models
+                price_info=PriceInfo(price=item_data.get('price', 0.0), currency_code="USD")
+            ),
+            quantity=quantity
+        ))
 
     # --- Track Purchase Event on Server-Side for Reliability ---
     if cart_at_checkout: # Only track if there was something in the cart
         try:
-            parent = user_event_client.catalog_path(
-                project=config.PROJECT_ID,
-                location=config.LOCATION,
-                catalog=config.CATALOG_ID
+            # Build the event proto directly; it is cheaper than assembling a
+            # JSON payload and parsing it back with UserEvent.from_json.
+            purchase_transaction = PurchaseTransaction(
+                id=transaction_id,
+                revenue=total_at_checkout,
+                currency_code="USD" # Assuming USD
             )
 
-            product_details = []
-            # Use the original cart data from session which includes price
-            for product_id, item_data in cart_from_session.items():
-                product_details.append({
-                    "product": {
-                        "id": product_id,
-                        # Include priceInfo for revenue optimization models
-                        "priceInfo": {
-                            "price": item_data.get('price', 0.0),
-                            "currencyCode": "USD"
-                        }
-                    },
-                    "quantity": item_data.get('quantity', 0)
-                })
-
-            purchase_transaction = {
-                "id": transaction_id,
-                "revenue": total_at_checkout,
-                "currencyCode": "USD" # Assuming USD
-            }
-
-            user_event_payload = {
-                "eventType": "purchase-complete",
-                "visitorId": visitor_id,
-                "cartId": visitor_id, # Use visitorId as a stable cartId
-                "productDetails": product_details,
-                "purchaseTransaction": purchase_transaction,
-                "uri": url_for('checkout', _external=True)
-            }
+            user_event = UserEvent(
+                event_type="purchase-complete",
+                visitor_id=visitor_id,
+                cart_id=visitor_id, # Use visitorId as a stable cartId
+                product_details=product_details,
+                purchase_transaction=purchase_transaction,
+                uri=url_for('checkout', _external=True),
+                # Add userInfo for a high-quality server-side event
+                user_info=_request_user_info()
+            )
 
-            # Add userInfo for a high-quality server-side event
-            user_info = {
-                "userAgent": request.user_agent.string,
-                "ipAddress": request.remote_addr
-            }
-            if session.get('user'):
-                user_info["userId"] = session['user']['sub']
-            user_event_payload['userInfo'] = user_info
-
-            user_event = UserEvent.from_json(json.dumps(user_event_payload))
-            write_request = WriteUserEventRequest(parent=parent, user_event=user_event)
-            user_event_client.write_user_event(request=write_request)
-            print(f"Successfully wrote server-side event: purchase-complete for visitor {visitor_id}")
-        except Exception as e:
+            # Queue the event rather than writing it inline so the redirect to
+            # the confirmation page doesn't wait on the Retail API.
+            _enqueue_user_event(user_event)
+            app.logger.debug("Queued server-side event: purchase-complete for visitor %s", visitor_id)
+        except Exception:
             # Log the error but don't block the user from completing the purchase
-            print(f"Error writing server-side purchase event: {e}\n{traceback.format_exc()}")
+            app.logger.exception("Error building server-side purchase event")
 
-    # Store checkout details in session to pass to the confirmation page
-    session['last_order'] = {
+    # Pass the checkout details to the confirmation page in a signed token
+    order_token = _create_order_token({
         'items': cart_at_checkout,
         'total': total_at_checkout,
         'transaction_id': transaction_id
-    }
+    })
 
     # Clear the cart
     session['cart'] = {}
     session['cart_total'] = 0.0
 
-    return redirect(url_for('purchase_confirmation'))
+    return redirect(url_for('purchase_confirmation', t=order_token))
+
+
+def _create_order_token(order):
+    """
+    Returns a signed token identifying a completed order for the confirmation
+    page URL. The token only carries the transaction ID, so order details never
+    end up in access logs or browser history. With Redis the order is stored
+    under that ID; otherwise it is kept in the visitor's session.
+    """
+    transaction_id = order['transaction_id']
+    if redis_client:
+        redis_client.setex(f"order:{transaction_id}", ORDER_TTL_SECONDS, orjson.dumps(order))
+    else:
+        session['last_order'] = order
+    return order_serializer.dumps({'tx': transaction_id})
+
+
+def _load_order(token):
+    """Returns the order for a token from `_create_order_token`, or None if it is invalid or expired."""
+    try:
+        payload = order_serializer.loads(token, max_age=ORDER_TTL_SECONDS)
+    except BadSignature:
+        return None
+    if redis_client:
+        order_json = redis_client.get(f"order:{payload['tx']}")
+        return orjson.loads(order_json) if order_json else None
+    order = session.get('last_order')
+    return order if order and order['transaction_id'] == payload['tx'] else None
+
+
+# The confirmation template is compiled once at startup and rendered directly,
+# skipping the template lookup on each view. In debug mode it is looked up by
+# name so that edits are still picked up by the template auto-reloader.
+purchase_confirmation_template = (
+    'purchase_confirmation.html' if app.debug
+    else app.jinja_env.get_template('purchase_confirmation.html')
+)
 
 
 @app.route('/purchase_confirmation')
 def purchase_confirmation():
     """Displays the purchase confirmation page."""
-    last_order = session.get('last_order')
-    if not last_order:
+    # Stale bookmarks and crawlers hit this page without a token; send them
+    # home before doing any signature or Redis work.
+    if 't' not in request.args:
         return redirect(url_for('index'))
 
-    # Clear the last order from session after displaying it to prevent re-submission on refresh.
-    session.pop('last_order', None)
-    return render_template('purchase_confirmation.html', order=last_order, event_type='purchase-complete')
+    # The order is looked up by the signed token in the URL, so a refresh shows
+    # the same order again until the token expires.
+    order = _load_order(request.args['t'])
+    if not order:
+        return redirect(url_for('index'))
+
+    return render_template(purchase_confirmation_template, order=order, event_type='purchase-complete')
 # --- GECX Chat Integration ---
 
 @app.route('/chat_gecx')
@@ -2049,13 +2481,15 @@ def api_chat_gecx():
         }
 
         # 2. Call the CES Agent Endpoint
-        res = requests.post(url, headers=headers, json=payload)
+        # The body is encoded (and the reply decoded) with orjson rather than
+        # the stdlib json module that requests' json= and .json() use.
+        res = requests.post(url, headers=headers, data=orjson.dumps(payload))
         
         if res.status_code != 200:
-            print(f"CES API Error: {res.text}")
+            app.logger.error("CES API Error: %s", res.text)
             return jsonify({"error": f"CES API failed with {res.status_code}", "details": res.text}), 500
 
-        data = res.json()
+        data = orjson.loads(res.content)
         bot_text = ""
         
         # 3. Format and save history matching chat.html formats
@@ -2095,8 +2529,7 @@ def api_chat_gecx():
                                             
                                         args = call_data.get("args", {})
                                         if isinstance(args, str):
-                                            import json as pyjson
-                                            try: args = pyjson.loads(args)
+                                            try: args = orjson.loads(args)
                                             except: pass
                                         product_id = args.get("product_id")
                                         
@@ -2139,14 +2572,10 @@ def api_chat_gecx():
                                             image_uri = p.get("thumbnail_url", "")
                                             if not image_uri and p_id:
                                                 try:
-                                                    branch = getattr(config, 'BRANCH_NAME', 'default_branch')
-                                                    p_name = product_client.product_path(
-                                                        config.PROJECT_ID, config.LOCATION, 
-                                                        config.CATALOG_ID, branch, p_id)
-                                                    full_product = product_client.get_product(name=p_name)
+                                                    full_product = _get_product(p_id)
                                                     image_uri = full_product.images[0].uri if full_product.images else ""
                                                 except Exception as e:
-                                                    print(f"Image hydrate failed for {p_id}: {e}")
+                                                    app.logger.warning("Image hydrate failed for %s: %s", p_id, e)
 
                                             formatted_result = {
                                                 "id": p_id,
@@ -2163,17 +2592,15 @@ def api_chat_gecx():
         bot_response['text'] = bot_text_html
 
         # Update Session History
-        session['chat_gecx_history'].append({'text': query, 'is_user': True})
-        session['chat_gecx_history'].append(bot_response)
-        session.modified = True
+        _append_chat_history('chat_gecx_history', {'text': query, 'is_user': True}, bot_response)
 
         return jsonify({
             "bot_response": bot_response,
             "conversation_id": session_id
         })
 
-    except Exception as e:
-        print(f"Unexpected error in api_chat_gecx: {e}\n{traceback.format_exc()}")
+    except Exception:
+        app.logger.exception("Unexpected error in api_chat_gecx")
         return jsonify({"error": "An unexpected error occurred"}), 500
 
 @app.route('/clear_chat_gecx', methods=['POST'])
@@ -2184,6 +2611,7 @@ def clear_chat_gecx():
     return redirect(url_for('chat_gecx'))
 
 if __name__ == '__main__':
-    # This block is for running the app directly with `python app.py`
-    # For production, use a WSGI server like Gunicorn.
-    app.run(debug=True, port=5000)
\ No newline at end of file
+    # This block is for running the app directly with `python app.py`.
+    # Set FLASK_DEBUG=1 for the debugger and reloader. For production, use
+    # gunicorn with the settings in gunicorn.conf.py.
+    app.run(debug=os.environ.get("FLASK_DEBUG") == "1", port=int(os.environ.get("PORT", 5000)))
\ No newline at end of file
@@ -26,6 +26,12 @@ RECOMMENDATION_SERVING_CONFIG_ID = os.environ.get("RECOMMENDATION_SERVING_CONFIG
 # string. In production, this MUST be set as an environment variable.
 SECRET_KEY = os.environ.get("SECRET_KEY")
 
+# --- Server-Side Session Storage (Optional) ---
+# When set (e.g. "redis://10.0.0.3:6379/0"), session data such as the cart is
+# kept in Redis and the browser only holds a session ID cookie. When unset,
+# the session is stored in the signed cookie itself.
+REDIS_URL = os.environ.get("REDIS_URL")
+
 # --- Google OAuth Configuration ---
 GOOGLE_CLIENT_ID = os.environ.get("GOOGLE_CLIENT_ID")
 GOOGLE_CLIENT_SECRET = os.environ.get("GOOGLE_CLIENT_SECRET")
@@ -56,6 +62,18 @@ SUPPORT_INTENT_URLS = {
 SITE_NAME = os.environ.get("SITE_NAME", "Vibe Commerce")
 SITE_LOGO_URL = os.environ.get("SITE_LOGO_URL", "/static/logo.png")
 
+# --- Logging Configuration (Optional) ---
+# Set to "DEBUG" to log the full request and response payloads of the
+# conversational search and support answer API calls.
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+
+# --- User Event Batching (Optional) ---
+# User events are queued and sent to the Retail API in batches by a background
+# thread. A batch is sent once it holds EVENT_BATCH_SIZE events or once
+# EVENT_FLUSH_INTERVAL_MS has passed since its first event, whichever is first.
+EVENT_BATCH_SIZE = int(os.environ.get("EVENT_BATCH_SIZE", "100"))
+EVENT_FLUSH_INTERVAL_MS = int(os.environ.get("EVENT_FLUSH_INTERVAL_MS", "200"))
+
 # --- Validate that all required environment variables are set ---
 # This ensures the application fails fast if configuration is missing.
 REQUIRED_CONFIG = {
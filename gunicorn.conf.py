@@ -0,0 +1,27 @@
+# gunicorn.conf.py
+# Production server settings, picked up automatically when gunicorn is started
+# from the project root (see the Dockerfile). Each value can be overridden
+# from the environment.
+import os
+
+# Cloud Run sets PORT for the container.
+bind = f":{os.environ.get('PORT', '8080')}"
+
+# Worker processes each run their own copy of the app: its API clients, caches,
+# product-fetch pool and user-event threads. A single worker keeps memory low
+# and the caches shared on small Cloud Run instances, and its pool of threads
+# keeps requests blocked on the Retail API from holding up others. Raise
+# GUNICORN_WORKERS on instances with more CPUs (e.g. one per CPU).
+workers = int(os.environ.get("GUNICORN_WORKERS", "1"))
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", "8"))
+
+# Keep idle client connections open longer than the upstream load balancer's
+# own keep-alive, so it never reuses a connection gunicorn has just closed.
+keepalive = int(os.environ.get("GUNICORN_KEEPALIVE", "75"))
+
+# Cloud Run enforces its own request timeout, so gunicorn's is disabled.
+timeout = 0
+
+# Stream HTTP access logs to stdout (Cloud Logging).
+accesslog = "-"